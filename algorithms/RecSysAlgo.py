@@ -1,7 +1,21 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
-from scipy.sparse import csc_matrix
+import os
+from scipy.sparse import csc_matrix, csr_matrix
+from scipy.sparse.linalg import svds
 from sparsesvd import sparsesvd as ssvd
 import numpy as np
+import pandas as pd
+
+from controllers.data_handler import dataset_fingerprint
+
+# decompositions cached by SVDAlgo, least recently used first. The cache holds at most
+# svd_cache_size decompositions (SVD_CACHE_SIZE by default, 0 disables it), see
+# set_svd_cache_size.
+SVD_CACHE_SIZE = 4
+svd_cache_size = SVD_CACHE_SIZE
+svd_cache = OrderedDict()
 
 
 class LowDimEmbeddingAlgo:
@@ -10,53 +24,253 @@ class LowDimEmbeddingAlgo:
         self.item_embeddings = None
         self.user_embeddings = None
         self.name = None
+        # whether fit also embeds the users (user_embeddings)
+        self.embeds_users = False
 
     def fit(self, data, k):
         raise NotImplementedError("fit(data, k) function must be implemented by inherited Algo "
                                   "object")
 
+    def get_params(self):
+        # hyperparameters that, along with k and the data, determine the fitted embeddings
+        return {}
+
 
-class ItemsSVDAlgo(LowDimEmbeddingAlgo):
+class SVDAlgo(LowDimEmbeddingAlgo):
+    # Base of the algorithms that embed items (and users) by a truncated SVD of the utility
+    # matrix. The leading k singular vectors of a rank-K decomposition (K > k) are the rank-k
+    # decomposition, so the largest decomposition computed for a utility matrix is cached and
+    # any smaller k is served by slicing it. The cache is shared by all instances, keyed by the
+    # data's fingerprint, the zero replacement and the solver, so e.g. a sweep over k
+    # decomposes once if it fits the largest k first. Its size is set by set_svd_cache_size.
+    #
+    # The decomposition is computed by one of SVD_SOLVERS: "sparsesvd" (SVDLIBC), "arpack"
+    # (scipy's svds) or "randomized" (a randomized range finder, much faster for low k on large
+    # sparse matrices). solver_params are passed to the solver, e.g. {"oversampling": 10,
+    # "n_iter": 4} for "randomized".
 
-    def __init__(self, replace_zero_by=-1):
+    def __init__(self, replace_zero_by=-1, solver="sparsesvd", solver_params=None):
         super().__init__()
+        if solver not in SVD_SOLVERS.keys():
+            raise ValueError("unknown SVD solver " + solver)
         self.utility_matrix = None
         self.zero_replacement = replace_zero_by
-        self.name = "ItemsSVDAlgo"
+        self.solver = solver
+        self.solver_params = {} if solver_params is None else solver_params
 
-    def fit(self, RecSysData, k):
+    def get_params(self):
+        params = {"replace_zero_by": self.zero_replacement}
+        if self.solver != "sparsesvd":
+            params.update(solver=self.solver, **self.solver_params)
+        return params
 
+    def build_utility_matrix(self, RecSysData):
         values = deepcopy(RecSysData.is_selected.values)
         values[np.where(values == 0)] = self.zero_replacement
         rows = RecSysData.user_index.values
         columns = RecSysData.template_index.values
         self.utility_matrix = csc_matrix((values, (rows, columns)))
 
-        _, _, ItemsEmbed = ssvd(self.utility_matrix, k)
+    def decompose(self, RecSysData, k):
+        self.build_utility_matrix(RecSysData)
+
+        key = (dataset_fingerprint(RecSysData), self.zero_replacement, self.solver,
+               tuple(sorted(self.solver_params.items())))
+        if key in svd_cache.keys() and svd_cache[key]["k"] >= k:
+            decomposition = svd_cache[key]
+            svd_cache.move_to_end(key)
+        else:
+            UsersEmbed, singular_values, ItemsEmbed = \
+                SVD_SOLVERS[self.solver](self.utility_matrix, k, **self.solver_params)
+            decomposition = {"k": k, "U": UsersEmbed, "S": singular_values, "Vt": ItemsEmbed}
+            svd_cache[key] = decomposition
+            svd_cache.move_to_end(key)
+            evict_svd_cache()
+
+        return decomposition["U"][:k], decomposition["S"][:k], decomposition["Vt"][:k]
+
+
+class ItemsSVDAlgo(SVDAlgo):
+
+    def __init__(self, replace_zero_by=-1, solver="sparsesvd", solver_params=None):
+        super().__init__(replace_zero_by, solver, solver_params)
+        self.name = "ItemsSVDAlgo"
+
+    def fit(self, RecSysData, k):
+
+        _, _, ItemsEmbed = self.decompose(RecSysData, k)
 
         self.item_embeddings = ItemsEmbed
 
 
-class ItemsUsersSVDAlgo(LowDimEmbeddingAlgo):
+class ItemsUsersSVDAlgo(SVDAlgo):
+    # Besides a full fit, the embeddings can be updated with new interactions:
+    # fold_in_users projects the interactions of new users through the fitted item factors,
+    # leaving the item embeddings untouched, and partial_fit applies new interactions of new and
+    # existing users as low-rank updates of the decomposition (Brand's incremental SVD). Once
+    # the interactions applied incrementally exceed refit_fraction of the utility matrix's
+    # non-zeros, partial_fit refits the full decomposition instead.
+    # A fold-in only touches the new users' interactions, which are added to the utility matrix
+    # in a batch by the next partial_fit.
 
-    def __init__(self, replace_zero_by=-1):
-        super().__init__()
-        self.utility_matrix = None
-        self.zero_replacement = replace_zero_by
+    def __init__(self, replace_zero_by=-1, solver="sparsesvd", solver_params=None,
+                 refit_fraction=0.2):
+        super().__init__(replace_zero_by, solver, solver_params)
         self.name = "ItemsUsersSVDAlgo"
+        self.embeds_users = True
+        self.singular_values = None
+        self.refit_fraction = refit_fraction
+        self.num_updated = 0
+        # interactions of folded-in users, not yet in the utility matrix
+        self.folded_in = []
 
     def fit(self, RecSysData, k):
 
-        values = deepcopy(RecSysData.is_selected.values)
-        values[np.where(values == 0)] = self.zero_replacement
+        UsersEmbed, singular_values, ItemsEmbed = self.decompose(RecSysData, k)
+
+        self.item_embeddings = ItemsEmbed
+        self.user_embeddings = UsersEmbed
+        self.singular_values = singular_values
+        self.num_updated = 0
+        self.folded_in = []
+
+    def restore(self, RecSysData, user_embeddings, singular_values, item_embeddings):
+        # restore the state of a fit of RecSysData from its stored decomposition, so that it can
+        # be updated without refitting
+        self.build_utility_matrix(RecSysData)
+        self.item_embeddings = np.asarray(item_embeddings)
+        self.user_embeddings = np.asarray(user_embeddings)
+        self.singular_values = np.asarray(singular_values)
+        self.num_updated = 0
+        self.folded_in = []
+
+    def fold_in_users(self, new_data):
+        # embed users that are not in the fitted data by projecting their rows of the utility
+        # matrix through the item factors: u = S^-1 Vt a. The rows are built from new_data
+        # alone, so the cost does not depend on the size of the utility matrix.
+        num_users = self.user_embeddings.shape[1]
+        if (new_data.user_index.values < num_users).any():
+            raise ValueError("fold_in_users only embeds new users; use partial_fit to update "
+                             "existing users")
+        new_data = new_data.groupby(by=["user_index", "template_index"]).\
+            agg({"is_selected": "max"}).reset_index()
+        self.folded_in.append(new_data)
+        num_items = max(self.item_embeddings.shape[1], new_data.template_index.max() + 1)
+        item_factors = pad_columns(self.item_embeddings, num_items)
+        values = np.where(new_data.is_selected.values == 1, 1, self.zero_replacement)
+        new_rows = csr_matrix((values, (new_data.user_index.values - num_users,
+                                        new_data.template_index.values)),
+                              shape=(new_data.user_index.max() + 1 - num_users, num_items))
+        singular_values = np.where(self.singular_values > 0, self.singular_values, 1)
+        new_users = (new_rows @ item_factors.T).T / singular_values[:, None]
+
+        self.item_embeddings = item_factors
+        self.user_embeddings = np.hstack((self.user_embeddings, new_users))
+
+    def partial_fit(self, new_data, batch_size=32):
+        # Brand's update of the rank-k decomposition for the changed rows of the utility matrix,
+        # batch_size users at a time (each batch costs O((n_users + n_items) * (k + batch_size)^2))
+        delta = self.apply_interactions(new_data)
+        self.num_updated += delta.nnz
+        k = len(self.singular_values)
+
+        if self.num_updated > self.refit_fraction * self.utility_matrix.nnz:
+            print("refitting algorithm %s with k=%g" % (self.name, k))
+            self.user_embeddings, self.singular_values, self.item_embeddings = \
+                SVD_SOLVERS[self.solver](self.utility_matrix, k, **self.solver_params)
+            self.num_updated = 0
+            return
+
+        U = pad_columns(self.user_embeddings, delta.shape[0]).T
+        V = pad_columns(self.item_embeddings, delta.shape[1]).T
+        S = self.singular_values
+        changed_users = np.unique(delta.nonzero()[0])
+        for start in range(0, len(changed_users), batch_size):
+            users = changed_users[start:start + batch_size]
+            X = np.zeros((len(U), len(users)))
+            X[users, np.arange(len(users))] = 1
+            Y = delta[users].toarray().T
+            U, S, V = brand_update(U, S, V, X, Y)
+
+        self.user_embeddings, self.singular_values, self.item_embeddings = U.T, S, V.T
+
+    def apply_interactions(self, new_data):
+        # add new interactions to the utility matrix, growing it for new users and items, and
+        # return the change. A (user, template) pair seen again keeps the max of its labels.
+        # The interactions of folded-in users are added along with them, but are not part of
+        # the change, since these users are already embedded.
+        if len(self.folded_in) > 0:
+            folded_in = pd.concat(self.folded_in)
+            self.folded_in = []
+            self.apply_interactions(folded_in)
+        new_data = new_data.groupby(by=["user_index", "template_index"]).\
+            agg({"is_selected": "max"}).reset_index()
+        rows = new_data.user_index.values
+        columns = new_data.template_index.values
+        shape = (max(self.utility_matrix.shape[0], rows.max() + 1),
+                 max(self.utility_matrix.shape[1], columns.max() + 1))
+
+        utility_matrix = self.utility_matrix.tocsr()
+        utility_matrix.resize(shape)
+        old_values = np.asarray(utility_matrix[rows, columns]).ravel()
+        new_values = np.where(new_data.is_selected.values == 1, 1, self.zero_replacement)
+        new_values = np.where(old_values == 1, 1, new_values)
+
+        delta = csr_matrix((new_values - old_values, (rows, columns)), shape=shape)
+        delta.eliminate_zeros()
+        self.utility_matrix = (utility_matrix + delta).tocsc()
+        return delta
+
+
+class ImplicitALSAlgo(LowDimEmbeddingAlgo):
+    # Implicit-feedback alternating least squares (Hu, Koren & Volinsky, 2008). Every preview is
+    # a positive preference, weighted by a confidence of 1 + alpha for selected previews and
+    # 1 + alpha * unselected_weight for previews that were not selected; templates a user did
+    # not preview are negative preferences with confidence 1. User and item factors are solved
+    # alternately by regularized weighted least squares.
+    #
+    # Each half-step solves one small k x k system per user (item): the systems of a chunk of
+    # chunk_size users are built and solved as a batch in NumPy, and chunks run on a pool of
+    # n_threads threads, since BLAS and LAPACK release the GIL. The cost of an iteration is
+    # linear in the number of interactions.
+
+    def __init__(self, alpha=40, unselected_weight=0.1, regularization=0.1, n_iter=15,
+                 n_threads=None, chunk_size=1024, seed=0):
+        super().__init__()
+        self.name = "ImplicitALSAlgo"
+        self.embeds_users = True
+        self.alpha = alpha
+        self.unselected_weight = unselected_weight
+        self.regularization = regularization
+        self.n_iter = n_iter
+        self.n_threads = n_threads if n_threads else os.cpu_count()
+        self.chunk_size = chunk_size
+        self.seed = seed
+
+    def get_params(self):
+        return {"alpha": self.alpha, "unselected_weight": self.unselected_weight,
+                "regularization": self.regularization, "n_iter": self.n_iter, "seed": self.seed}
+
+    def fit(self, RecSysData, k):
+
+        strength = np.where(RecSysData.is_selected.values == 1, 1.0, self.unselected_weight)
         rows = RecSysData.user_index.values
         columns = RecSysData.template_index.values
-        self.utility_matrix = csc_matrix((values, (rows, columns)))
+        confidence = csr_matrix((self.alpha * strength, (rows, columns)))
 
-        UsersEmbed, _, ItemsEmbed = ssvd(self.utility_matrix, k)
+        random_state = np.random.RandomState(self.seed)
+        UsersEmbed = 0.01 * random_state.standard_normal((confidence.shape[0], k))
+        ItemsEmbed = 0.01 * random_state.standard_normal((confidence.shape[1], k))
+        item_confidence = confidence.T.tocsr()
+        with ThreadPoolExecutor(max_workers=self.n_threads) as pool:
+            for _ in range(self.n_iter):
+                UsersEmbed = als_step(confidence, ItemsEmbed, self.regularization,
+                                      self.chunk_size, pool)
+                ItemsEmbed = als_step(item_confidence, UsersEmbed, self.regularization,
+                                      self.chunk_size, pool)
 
-        self.item_embeddings = ItemsEmbed
-        self.user_embeddings = UsersEmbed
+        self.item_embeddings = ItemsEmbed.T
+        self.user_embeddings = UsersEmbed.T
 
 
 class RandomEmbeddingAlgo(LowDimEmbeddingAlgo):
@@ -71,10 +285,128 @@ class RandomEmbeddingAlgo(LowDimEmbeddingAlgo):
     def fit(self, RecSysData, k):
 
         num_items = RecSysData.template_index.max() + 1
-        self.embeddings = 2 * np.random.rand(k, num_items) - 1
+        self.item_embeddings = 2 * np.random.rand(k, num_items) - 1
+
+
+def set_svd_cache_size(size):
+    # the number of decompositions that SVDAlgo keeps; 0 disables the cache
+    global svd_cache_size
+    svd_cache_size = size
+    evict_svd_cache()
+
+
+def clear_svd_cache():
+    svd_cache.clear()
+
+
+def evict_svd_cache():
+    while len(svd_cache) > svd_cache_size:
+        svd_cache.popitem(last=False)
+
+
+# All SVD solvers take a sparse matrix A and k, and return (U, S, Vt) as sparsesvd does: U of
+# shape (k, n_rows) and Vt of shape (k, n_columns) hold the left and right singular vectors as
+# rows, and S holds the k largest singular values in descending order.
+
+def sparsesvd_solver(matrix, k):
+    return ssvd(csc_matrix(matrix), k)
+
+
+def arpack_svd(matrix, k, tol=0):
+    U, S, Vt = svds(matrix.astype(float), k=k, tol=tol)
+    order = np.argsort(-S)
+    return U[:, order].T, S[order], Vt[order]
+
+
+def randomized_svd(matrix, k, oversampling=10, n_iter=4, seed=0):
+    # Randomized range finder (Halko, Martinsson & Tropp): the range of A is approximated by
+    # A @ Omega for a random Gaussian Omega with k + oversampling columns, refined by n_iter
+    # power iterations (re-orthonormalized for stability). The SVD of the small projected matrix
+    # Q.T @ A then gives the leading singular triplets of A.
+    matrix = matrix.astype(float)
+    n_components = min(k + oversampling, min(matrix.shape))
+    random_state = np.random.RandomState(seed)
+    Q, _ = np.linalg.qr(matrix @ random_state.standard_normal((matrix.shape[1], n_components)))
+    for _ in range(n_iter):
+        Q, _ = np.linalg.qr(matrix.T @ Q)
+        Q, _ = np.linalg.qr(matrix @ Q)
+    Ub, S, Vt = np.linalg.svd(np.asarray((matrix.T @ Q).T), full_matrices=False)
+    return (Q @ Ub[:, :k]).T, S[:k], Vt[:k]
+
+
+def brand_update(U, S, V, X, Y):
+    # Rank-k SVD of A + X Y^T given the rank-k SVD A = U diag(S) V^T (Brand, 2006). The parts of
+    # X and Y orthogonal to the current singular subspaces are orthonormalized (P, Q), the
+    # small (k + c) x (k + c) core matrix is diagonalized, and the bases are rotated and
+    # truncated back to rank k.
+    k = len(S)
+    M = U.T @ X
+    P, Ra = np.linalg.qr(X - U @ M)
+    N = V.T @ Y
+    Q, Rb = np.linalg.qr(Y - V @ N)
+
+    core = np.zeros((k + X.shape[1], k + Y.shape[1]))
+    core[:k, :k] = np.diag(S)
+    core += np.vstack((M, Ra)) @ np.vstack((N, Rb)).T
+    core_U, core_S, core_Vt = np.linalg.svd(core)
+
+    U = np.hstack((U, P)) @ core_U[:, :k]
+    V = np.hstack((V, Q)) @ core_Vt[:k].T
+    return U, core_S[:k], V
+
+
+def als_step(confidence, fixed, regularization, chunk_size, pool):
+    # Solve the factors of all rows of confidence (a CSR matrix holding c - 1 for every
+    # interaction) given the fixed factors of the columns. For row u with interactions I_u:
+    # (F^T F + F_u^T diag(c_u - 1) F_u + reg * I) x_u = F_u^T c_u
+    # Rows are ordered by their number of interactions and cut into chunks of up to chunk_size
+    # rows (and about 32MB of gathered factors). The factors of each chunk's interactions are
+    # gathered into a zero-padded (rows, max interactions, k) array, so that all of the chunk's
+    # systems are built by one batched matrix product and solved by one batched solve.
+    k = fixed.shape[1]
+    gram = fixed.T @ fixed + regularization * np.eye(k)
+    num_interactions = np.diff(confidence.indptr)
+    order = np.argsort(num_interactions, kind="stable")
+    max_elements = 2 ** 22 // k
+
+    def solve_chunk(bounds):
+        rows = order[bounds[0]:bounds[1]]
+        length = num_interactions[rows[-1]]
+        padded = np.arange(length) < num_interactions[rows, None]
+        positions = np.where(padded, confidence.indptr[rows, None] + np.arange(length), 0)
+        factors = fixed[confidence.indices[positions]]
+        weights = np.where(padded, confidence.data[positions], 0)
+
+        A = gram + np.matmul((factors * weights[:, :, None]).transpose(0, 2, 1), factors)
+        b = (factors * (padded + weights)[:, :, None]).sum(axis=1)
+        return np.linalg.solve(A, b[:, :, None])[:, :, 0]
+
+    chunks = []
+    start = 0
+    while start < len(order):
+        end = min(start + chunk_size, len(order))
+        # rows are sorted by length, so the chunk's last row is its longest
+        while end - start > 1 and (end - start) * num_interactions[order[end - 1]] > max_elements:
+            end = start + (end - start) // 2
+        chunks.append((start, end))
+        start = end
+
+    solutions = np.empty((confidence.shape[0], k))
+    for (start, end), solution in zip(chunks, pool.map(solve_chunk, chunks)):
+        solutions[order[start:end]] = solution
+    return solutions
+
+
+def pad_columns(embeddings, num_columns):
+    # embeddings of shape (k, n) padded with zero columns (entities with no embedding yet)
+    padding = np.zeros((embeddings.shape[0], num_columns - embeddings.shape[1]))
+    return np.hstack((embeddings, padding))
+
 
+SVD_SOLVERS = {"sparsesvd": sparsesvd_solver, "arpack": arpack_svd,
+               "randomized": randomized_svd}
 
-available_algorithms = [ItemsSVDAlgo, RandomEmbeddingAlgo]
+available_algorithms = [ItemsSVDAlgo, ItemsUsersSVDAlgo, ImplicitALSAlgo, RandomEmbeddingAlgo]
 
 
 if __name__ == "__main__":
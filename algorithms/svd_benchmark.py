@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csc_matrix
+from scipy.sparse.linalg import norm as sparse_norm
+
+from algorithms.RecSysAlgo import SVD_SOLVERS
+
+
+def reconstruction_error(matrix, U, S, Vt):
+    # relative Frobenius error ||A - U.T diag(S) Vt|| / ||A||, computed without forming the dense
+    # reconstruction: for orthonormal singular vectors, ||A - U.T S Vt||^2 =
+    # ||A||^2 - 2 sum_i S_i u_i.A v_i + sum_i S_i^2
+    matrix_norm = sparse_norm(matrix)
+    projections = np.einsum("ij,ji->i", U, matrix @ Vt.T)
+    squared_error = matrix_norm ** 2 - 2 * (S * projections).sum() + (S ** 2).sum()
+    return np.sqrt(max(squared_error, 0)) / matrix_norm
+
+
+def benchmark_solvers(RecSysData, k_values, solvers=None, replace_zero_by=-1, repeats=3):
+    # report the fit time (best of repeats) and the reconstruction error of each SVD solver on
+    # the utility matrix of RecSysData, for each k
+    solvers = list(SVD_SOLVERS.keys()) if solvers is None else solvers
+    values = RecSysData.is_selected.values.astype(float)
+    values[values == 0] = replace_zero_by
+    matrix = csc_matrix((values, (RecSysData.user_index.values,
+                                  RecSysData.template_index.values)))
+    print("utility matrix of shape %s with %g non-zeros" % (str(matrix.shape), matrix.nnz))
+
+    results = []
+    for k in k_values:
+        for solver in solvers:
+            fit_times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                U, S, Vt = SVD_SOLVERS[solver](matrix, k)
+                fit_times.append(time.perf_counter() - start)
+            results.append({"solver": solver, "k": k, "fit_time": min(fit_times),
+                            "reconstruction_error": reconstruction_error(matrix, U, S, Vt)})
+    results = pd.DataFrame(results)
+    print(results)
+    return results
+
+
+if __name__ == "__main__":
+    from controllers.data_handler import DataHandler
+
+    data_specs = {"project_name": "story", "data_name": "min_previews 5"}
+    dh = DataHandler(data_specs)
+    benchmark_solvers(dh.getData("all"), k_values=[2, 10, 30])
@@ -1,5 +1,15 @@
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+import pandas as pd
+from scipy import stats
+
+from algorithms.RecSysAlgo import ItemsSVDAlgo, SVDAlgo, clear_svd_cache
 from controllers.Viewer import ThumbnailViewer
+from recommendation.Recommender import ItemSimilarityRecommender
+from similarity_functions.SimFunc import CosineSimilarity
 
 
 class Evaluator:
@@ -20,7 +30,9 @@ class Evaluator:
                  get_recom_for=None, n_for_recom=10,
                  print_recom=True, view_recom=False,
                  print_recom_category_match_index=False, calc_hitRate=False, n_for_hitRate=10,
-                 show_hit_position_index=False, calc_novelty_score=False, n_for_novelty=10):
+                 show_hit_position_index=False, calc_novelty_score=False, n_for_novelty=10,
+                 calc_neighbor_recall=False, n_for_neighbor_recall=10, n_splits=1,
+                 split_method="LOO", n_jobs=1):
 
         if find_nearest_to:
             self.find_nearest_items(find_nearest_to, n_nearest_to, print_nearest, view_nearest,
@@ -33,23 +45,111 @@ class Evaluator:
             self.recommend(get_recom_for, n_for_recom, print_recom,
                            view_recom, print_recom_category_match_index)
 
-        if calc_hitRate:
+        if calc_hitRate and (n_splits > 1 or split_method != "LOO"):
+            self.calculate_split_hit_rate(n_for_hitRate, n_splits, split_method, n_jobs)
+        elif calc_hitRate:
             self.calculate_hit_rate(n_for_hitRate, show_hit_position_index)
 
         if calc_novelty_score:
             self.calculate_novelty_score(n_for_novelty)
 
+        if calc_neighbor_recall:
+            self.calculate_neighbor_recall(n_for_neighbor_recall)
+
     def calculate_hit_rate(self, n, show_hit_position_index):
 
         for recommender, recommender_name in self.recommenders:
-            hit_rate = recommender.calc_hit_rate(n)
-            print("Hit Rate of recommender %s with %g recommendations per user: %g\n" %
-                  (recommender_name, n, hit_rate))
+            if not show_hit_position_index:
+                hit_rate = recommender.calc_hit_rate(n)
+                print("Hit Rate of recommender %s with %g recommendations per user: %g\n" %
+                      (recommender_name, n, hit_rate))
+                continue
 
-        if show_hit_position_index:
             # for each user, find the position in the ranked items of the left-out item,
-            # and return the min, Q1, median, Q3 and max
-            pass
+            # and return the min, Q1, median, Q3 and max (over users with a hit)
+            metrics = recommender.calc_metrics(n)
+            print("Hit Rate of recommender %s with %g recommendations per user: %g" %
+                  (recommender_name, n, metrics["hit_rate"]))
+            print("hit position index: " + ", ".join(
+                "%s %g" % quantile for quantile in metrics["hit_position"].items()))
+            print("MRR: %g, NDCG@%g: %g, coverage: %g\n" %
+                  (metrics["mrr"], n, metrics["ndcg"], metrics["coverage"]))
+
+    def calculate_split_hit_rate(self, n, n_splits, split_method="LOO", n_jobs=1, seed=0):
+        # Hit rate over several held-out splits: n_splits LOO draws with seeds seed,
+        # seed + 1, ... (split_method "LOO"), or the n_splits folds of a K-fold holdout
+        # (split_method "kfold", see DataHandler.prepare_fold_dataset). Each split gets its own
+        # dataset, on which the models are refitted. Splits run on a pool of n_jobs processes;
+        # with the fork start method the workers share the data handlers' base interaction
+        # arrays read-only instead of receiving copies. Returns the mean hit rate of each
+        # recommender, the half-width of its 95% confidence interval, and the per-split hit
+        # rates.
+        recommenders = [recommender for recommender, _ in self.recommenders]
+        splits = [(split_method, split, n_splits, seed, n) for split in range(n_splits)]
+
+        if n_jobs == 1:
+            split_hit_rates = [evaluate_split(recommenders, *split) for split in splits]
+        else:
+            with process_pool(n_jobs, recommenders) as pool:
+                split_hit_rates = list(pool.map(evaluate_split_in_worker, splits))
+
+        results = {}
+        split_hit_rates = np.array(split_hit_rates)
+        for i, (_, recommender_name) in enumerate(self.recommenders):
+            hit_rates = split_hit_rates[:, i]
+            ci = stats.t.ppf(0.975, n_splits - 1) * hit_rates.std(ddof=1) / np.sqrt(n_splits) \
+                if n_splits > 1 else np.nan
+            results[recommender_name] = {"mean": hit_rates.mean(), "ci": ci,
+                                         "hit_rates": hit_rates}
+            print("Hit Rate of recommender %s with %g recommendations per user over %g %s "
+                  "splits: %g +- %g\n" % (recommender_name, n, n_splits, split_method,
+                                          hit_rates.mean(), ci))
+        return results
+
+    def sweep(self, data_handler, grid, metrics, n=10, n_jobs=1, store=None, seed=0,
+              **recommender_kwargs):
+        # Evaluate every combination of a hyperparameter grid. grid maps each of "recommender"
+        # (ItemSimilarityRecommender or UserBasedRecommender), "algo" (an algorithm class),
+        # "replace_zero_by", "k", "simfunc" and "scores_chart" to a list of values; metrics is a
+        # list of "hit_rate", "mrr", "ndcg", "coverage", "match_index" and "novelty".
+        # replace_zero_by only applies to the SVD based algorithms. Further constructor arguments
+        # of the algorithms are given by grid["algo_params"], which maps an algorithm class to a
+        # list of keyword argument dicts (e.g. {ImplicitALSAlgo: [{"alpha": 10}, {"alpha": 40}]}),
+        # each of which is a grid value; by default algorithms get none. The LOO
+        # metrics (hit rate, MRR, NDCG and coverage) are computed together from one set of
+        # recommendations. Further keyword arguments are passed to the recommenders (e.g.
+        # n_neighbors).
+        #
+        # The scores chart does not affect the fitted model, so the model of each (recommender,
+        # algo, replace_zero_by, k, simfunc) is fitted once and all scores charts are evaluated
+        # with it. The match index does not depend on the scores chart either and is computed
+        # once per model. Combinations that differ only in k and the scores chart form one job,
+        # which fits the largest k first so that SVD based algorithms decompose once and slice
+        # the decomposition for smaller k. Jobs run on a pool of n_jobs processes that share the
+        # data handler and its LOO split (prepared beforehand with seed). Returns a DataFrame
+        # with one row per combination.
+        grid = dict(SWEEP_DEFAULTS, **grid)
+        job_keys = ["recommender", "algo", "algo_params", "replace_zero_by", "simfunc"]
+        jobs = []
+        for algo in grid["algo"]:
+            algo_grid = dict(grid, algo=[algo], algo_params=grid["algo_params"].get(algo, [{}]))
+            if not issubclass(algo, SVDAlgo):
+                algo_grid["replace_zero_by"] = [None]
+            jobs += [(dict(zip(job_keys, values)), sorted(grid["k"], reverse=True),
+                      grid["scores_chart"], metrics, n, store, recommender_kwargs)
+                     for values in itertools.product(*[algo_grid[key] for key in job_keys])]
+
+        if any(metric in LOO_METRICS for metric in metrics):
+            data_handler.prepare_LOO_dataset(seed=seed)
+        if n_jobs == 1:
+            job_rows = [evaluate_sweep_job(data_handler, *job) for job in jobs]
+        else:
+            with process_pool(n_jobs, data_handler) as pool:
+                job_rows = list(pool.map(evaluate_sweep_job_in_worker, jobs))
+
+        results = pd.DataFrame([row for rows in job_rows for row in rows])
+        print(results)
+        return results
 
     def calculate_match_index(self, n):
         # For each model, get n nearest neighbors for all items and calc match index (mean match
@@ -66,6 +166,17 @@ class Evaluator:
             print("Novely score of recommender %s with %g recommendations per user: %g\n" %
                   (recommender_name, n, novelty_score))
 
+    def calculate_neighbor_recall(self, n):
+        # recall of the nearest users found by each user based recommender against an exact
+        # search. Recommenders that do not search for neighboring users are skipped.
+
+        for recommender, recommender_name in self.recommenders:
+            if not hasattr(recommender, "calc_neighbor_recall"):
+                continue
+            recall = recommender.calc_neighbor_recall(n)
+            print("Neighbor recall of recommender %s with %g neighbors per user: %g\n" %
+                  (recommender_name, n, recall))
+
     def find_nearest_items(self, find_nearest_to, n_nearest_to, print_nearest, view_nearest,
                            print_category_match_index):
         nearestToItem = {}
@@ -110,8 +221,122 @@ class Evaluator:
                     self.viewer.view_user_recommendations(user, user_recomms)
 
 
+SWEEP_DEFAULTS = {"recommender": [ItemSimilarityRecommender], "algo": [ItemsSVDAlgo],
+                  "algo_params": {}, "replace_zero_by": [-1], "k": [10],
+                  "simfunc": [CosineSimilarity], "scores_chart": [{"0": 0, "1": 1}]}
+
+# sweep metrics that are computed on the LOO dataset
+LOO_METRICS = ["hit_rate", "mrr", "ndcg", "coverage"]
+
+
+def prepare_split(data_handler, split_method, split, n_splits, seed):
+    if split_method == "LOO":
+        dataset = "LOO seed %g" % (seed + split)
+        data_handler.prepare_LOO_dataset(seed=seed + split, dataset=dataset)
+    elif split_method == "kfold":
+        dataset = "fold %g/%g" % (split, n_splits)
+        data_handler.prepare_fold_dataset(split, n_splits, seed=seed, dataset=dataset)
+    else:
+        raise ValueError("unknown split method " + split_method)
+    return dataset
+
+
+def evaluate_split(recommenders, split_method, split, n_splits, seed, n):
+    # prepare the split on the data handler of each recommender, compute the hit rates and
+    # release the split's dataset
+    data_handlers = {id(recommender.data_handler): recommender.data_handler
+                     for recommender in recommenders}
+    datasets = {key: prepare_split(data_handler, split_method, split, n_splits, seed)
+                for key, data_handler in data_handlers.items()}
+    hit_rates = [recommender.calc_hit_rate(n, dataset=datasets[id(recommender.data_handler)])
+                 for recommender in recommenders]
+    for key, data_handler in data_handlers.items():
+        data_handler.dropDataset(datasets[key])
+    return hit_rates
+
+
+def evaluate_sweep_job(data_handler, params, k_values, scores_charts, metrics, n, store,
+                       recommender_kwargs):
+    rows = []
+    for k in k_values:
+        rows += evaluate_grid_point(data_handler, dict(params, k=k), scores_charts, metrics, n,
+                                    store, recommender_kwargs)
+    return rows
+
+
+def evaluate_grid_point(data_handler, fit_params, scores_charts, metrics, n, store,
+                        recommender_kwargs):
+    # evaluate all scores charts of one grid point, sharing a single model between them. Metrics
+    # are computed one at a time for all charts, since the model refits when switching between
+    # the LOO dataset (hit rate) and the full dataset (match index, novelty).
+    rows = []
+    recommenders = []
+    for scores_chart in scores_charts:
+        algo_params = dict(fit_params["algo_params"])
+        if fit_params["replace_zero_by"] is not None:
+            algo_params["replace_zero_by"] = fit_params["replace_zero_by"]
+        algo = fit_params["algo"](**algo_params)
+        recommender = fit_params["recommender"](data_handler, algo, fit_params["k"],
+                                                fit_params["simfunc"], scores_chart,
+                                                store=store, **recommender_kwargs)
+        if len(recommenders) > 0:
+            recommender.model = recommenders[0].model
+        recommenders.append(recommender)
+        rows.append({"recommender": fit_params["recommender"].__name__, "algo": algo.name,
+                     "algo_params": str(fit_params["algo_params"]),
+                     "replace_zero_by": fit_params["replace_zero_by"], "k": fit_params["k"],
+                     "simfunc": recommender.model.sim_func.name,
+                     "scores_chart": str(scores_chart)})
+
+    loo_metrics = [metric for metric in metrics if metric in LOO_METRICS]
+    if len(loo_metrics) > 0:
+        for row, recommender in zip(rows, recommenders):
+            recommender_metrics = recommender.calc_metrics(n)
+            for metric in loo_metrics:
+                row[metric] = recommender_metrics[metric]
+    if "match_index" in metrics:
+        match_index = recommenders[0].calc_match_index(n)
+        for row in rows:
+            row["match_index"] = match_index
+    if "novelty" in metrics:
+        for row, recommender in zip(rows, recommenders):
+            row["novelty"] = recommender.calc_novelty_score(n)
+    return rows
+
+
+def process_pool(n_jobs, worker_state):
+    # A pool of n_jobs processes, each holding worker_state (e.g. data handlers) in the module
+    # global worker_state. With the fork start method the state is inherited by the workers,
+    # sharing the parent's memory pages, rather than pickled to each of them.
+    context = multiprocessing.get_context("fork") if \
+        "fork" in multiprocessing.get_all_start_methods() else None
+    return ProcessPoolExecutor(max_workers=n_jobs, mp_context=context,
+                               initializer=init_worker, initargs=(worker_state,))
+
+
+# state of the process pool's workers, set once per worker by init_worker
+worker_state = None
+
+
+def init_worker(state):
+    # forked workers start without the decompositions cached by the parent, which each worker
+    # would otherwise hold on to (see SVDAlgo)
+    global worker_state
+    worker_state = state
+    clear_svd_cache()
+
+
+def evaluate_split_in_worker(split):
+    return evaluate_split(worker_state, *split)
+
+
+def evaluate_sweep_job_in_worker(job):
+    return evaluate_sweep_job(worker_state, *job)
+
+
 if __name__ == "__main__":
     from controllers.data_handler import DataHandler
+    from controllers.artifact_store import ArtifactStore
     from algorithms.RecSysAlgo import ItemsSVDAlgo, ItemsUsersSVDAlgo
     from similarity_functions.SimFunc import CosineSimilarity
     from recommendation.Recommender import ItemSimilarityRecommender, RandomRecommender, \
@@ -123,6 +348,7 @@ if __name__ == "__main__":
 
     data_specs = {"project_name": "story", "data_name": "min_previews 5"}
     dh = DataHandler(data_specs)
+    store = ArtifactStore(max_bytes=20 * 2 ** 30)
     E = Evaluator()
 
     # establish SVD Recommenders
@@ -131,7 +357,8 @@ if __name__ == "__main__":
         algo = ItemsSVDAlgo(replace_zero_by=1)
         simfunc = CosineSimilarity
         scores_chart = {"0": 1, "1": 1}
-        SVD_recommender = ItemSimilarityRecommender(dh, algo, k, simfunc, scores_chart)
+        SVD_recommender = ItemSimilarityRecommender(dh, algo, k, simfunc, scores_chart,
+                                                    store=store)
         # E.add_recommender(SVD_recommender, f"SVD_k%g_cosine" % k)
 
     # establish random recommendation algorithm
@@ -150,10 +377,19 @@ if __name__ == "__main__":
                 simfunc = CosineSimilarity
                 scores_chart = {"0": zero_score, "1": 1}
                 SVD_user_based = UserBasedRecommender(dh, algo, k, simfunc, scores_chart,
-                                                      n_neighbors=10, d_neighbors=5, d_user=5)
+                                                      n_neighbors=10, d_neighbors=5, d_user=5,
+                                                      store=store)
                 # E.add_recommender(SVD_user_based, "zero_replacements: %g; k: %g; zero_score: %g" %
                 #                   (zero_replacement, k, zero_score))
 
+    # the same user based grid as a parallel sweep, fitting one SVD per (zero_replacement, k)
+    user_based_grid = {"recommender": [UserBasedRecommender], "algo": [ItemsUsersSVDAlgo],
+                       "replace_zero_by": [-1, 0, 1], "k": [10, 20, 30],
+                       "scores_chart": [{"0": zero_score, "1": 1}
+                                        for zero_score in [-1, 0, 0.5, 1]]}
+    # sweep_results = E.sweep(dh, user_based_grid, ["hit_rate"], n=6, n_jobs=4, store=store,
+    #                         n_neighbors=10, d_neighbors=5, d_user=5)
+
     E.evaluate(calc_hitRate=True, n_for_hitRate=6)
     # E.evaluate(calc_match_index=True, n_for_match_index=6)
     # E.evaluate(calc_novelty_score=True, n_for_novelty=6)
@@ -1,3 +1,6 @@
+import numpy as np
+
+from controllers.data_handler import dataset_fingerprint
 
 
 class ItemSimilarityModel:
@@ -9,86 +12,257 @@ class ItemSimilarityModel:
     # An instance is therefore initiated with a RecSysAlgo object, an integer k and a SimFunc
     # object. The Model class hosts a get_similarities function and a get_embeddings function
     # (both take data as argument).
+    #
+    # An optional ArtifactStore persists the embeddings and similarities, so that they are
+    # fitted once per algorithm, hyperparameters and dataset across runs and processes.
+    #
+    # Nearest neighbor queries are served by an item-kNN table of the knn_size nearest items of
+    # every item (see GetItemNeighbors), built once per fit and persisted along with the other
+    # artifacts. With drop_similarities, the dense similarity matrix is released once the table
+    # is built, and recomputed only if requested again.
+    #
+    # Embeddings and similarities are held in dtype, e.g. float32 for the single precision mode
+    # of the DataHandler (see DataHandler.dtypes).
 
-    def __init__(self, algo, k, SimFunc):
+    def __init__(self, algo, k, SimFunc, store=None, knn_size=100, drop_similarities=False,
+                 dtype=np.float64):
         self.algo = algo
         self.k = k
         self.sim_func = SimFunc(k)
+        self.store = store
+        self.dtype = dtype
+        self.knn_size = knn_size
+        self.drop_similarities = drop_similarities
         self.embeddings = None
         self.embeddings_of = None
         self.similarities = None
         self.similarities_of = None
+        self.item_knn = None
+        self.item_knn_of = None
+
+    def GetEmbeddings(self, data, fingerprint=None):
+        # the cached embeddings are identified by the fingerprint of the data they were fitted
+        # on. Callers that hold a precomputed fingerprint (see DataHandler.getFingerprint) save
+        # hashing the data.
+        fingerprint = dataset_fingerprint(data) if fingerprint is None else fingerprint
+        if self.embeddings_of == fingerprint:
+            return self.embeddings
+        key = artifact_key(self.store, self.algo, self.k, fingerprint, dtype=self.dtype)
+        stored = load_artifact(self.store, key, "item_embeddings")
+        if stored is not None:
+            self.embeddings = stored
+        else:
+            print("fitting algorithm %s with k=%g" % (self.algo.name, self.k))
+            self.algo.fit(data, self.k)
+            self.embeddings = save_artifact(self.store, key, "item_embeddings",
+                                            self.algo.item_embeddings, self.dtype)
+        self.embeddings_of = fingerprint
+        return self.embeddings
 
-    def GetEmbeddings(self, data):
-            if self.embeddings_of is not None and data.shape == self.embeddings_of.shape and \
-                    (data.values == self.embeddings_of.values).all():
-                return self.embeddings
-            else:
-                print("fitting algorithm %s with k=%g" % (self.algo.name, self.k))
-                self.algo.fit(data, self.k)
-                self.embeddings = self.algo.item_embeddings
-                self.embeddings_of = data
-                return self.embeddings
-
-    def GetSimilarities(self, data):
-        if self.similarities_of is not None and data.shape == self.similarities_of.shape and \
-                (data.values == self.similarities_of.values).all():
+    def GetSimilarities(self, data, fingerprint=None):
+        fingerprint = dataset_fingerprint(data) if fingerprint is None else fingerprint
+        if self.similarities_of == fingerprint:
             return self.similarities
+        key = artifact_key(self.store, self.algo, self.k, fingerprint, self.sim_func,
+                           self.dtype)
+        stored = load_artifact(self.store, key, "similarities")
+        if stored is not None:
+            self.similarities = stored
         else:
             print("calculating similarities by algorithm %s with k=%g and similarity function "
                   "%s" % (self.algo.name, self.k, self.sim_func.name))
-            self.similarities = self.sim_func(self.GetEmbeddings(data))
-            self.similarities_of = data
-            return self.similarities
+            self.similarities = save_artifact(
+                self.store, key, "similarities",
+                self.sim_func(self.GetEmbeddings(data, fingerprint)), self.dtype)
+        self.similarities_of = fingerprint
+        return self.similarities
+
+    def GetItemNeighbors(self, data, n, fingerprint=None):
+        # the n nearest items of every item (other than itself) and their similarities, as
+        # (n_items, n) arrays sliced from the item-kNN table. The table is rebuilt only for a new
+        # fit, or when n exceeds knn_size.
+        fingerprint = dataset_fingerprint(data) if fingerprint is None else fingerprint
+        if self.item_knn_of != fingerprint or n > self.knn_size:
+            self.knn_size = max(self.knn_size, n)
+            self.item_knn = get_item_knn(self.store, self.algo, self.k, fingerprint,
+                                         self.sim_func, self.GetEmbeddings(data, fingerprint),
+                                         self.knn_size, self.dtype)
+            self.item_knn_of = fingerprint
+            if self.drop_similarities:
+                self.similarities = None
+                self.similarities_of = None
+        nearest_items, similarities = self.item_knn
+        return nearest_items[:, :n], similarities[:, :n]
 
 
 class LowDimEmbeddingModel:
     # The Model class hosts a get_item_similarities function, get_item_embeddings and
-    # get_user_embeddings functions (both take data as argument).
+    # get_user_embeddings functions (both take data as argument). Item neighbors are served by
+    # an item-kNN table, as in ItemSimilarityModel.
 
-    def __init__(self, algo, k, SimFunc):
+    def __init__(self, algo, k, SimFunc, store=None, knn_size=100, drop_similarities=False,
+                 dtype=np.float64):
         self.algo = algo
         self.k = k
         self.sim_func = SimFunc(k)
+        self.store = store
+        self.dtype = dtype
+        self.knn_size = knn_size
+        self.drop_similarities = drop_similarities
         self.item_embeddings = None
         self.user_embeddings = None
         self.embeddings_of = None
         self.item_similarities = None
         self.similarities_of = None
+        self.item_knn = None
+        self.item_knn_of = None
 
-    def GetEmbeddings(self, data):
-        print("fitting algorithm %s with k=%g" % (self.algo.name, self.k))
-        self.algo.fit(data, self.k)
-        self.item_embeddings = self.algo.item_embeddings
-        self.user_embeddings = self.algo.user_embeddings
-        self.embeddings_of = data
-
-    def GetItemEmbeddings(self, data):
-        if self.embeddings_of is not None and data.shape == self.embeddings_of.shape and \
-                (data.values == self.embeddings_of.values).all():
-            return self.item_embeddings
+    def GetEmbeddings(self, data, fingerprint=None):
+        fingerprint = dataset_fingerprint(data) if fingerprint is None else fingerprint
+        key = artifact_key(self.store, self.algo, self.k, fingerprint, dtype=self.dtype)
+        # only the artifacts that the algorithm produces are stored: user embeddings of
+        # algorithms that embed users, and the singular values of algorithms that can update
+        # their embeddings (see UpdateEmbeddings), which restore the state of the fit from them
+        item_embeddings = load_artifact(self.store, key, "item_embeddings")
+        user_embeddings = load_artifact(self.store, key, "user_embeddings") if \
+            self.algo.embeds_users else None
+        updatable = hasattr(self.algo, "restore")
+        singular_values = load_artifact(self.store, key, "singular_values") if updatable \
+            else None
+        if item_embeddings is not None and \
+                (user_embeddings is not None or not self.algo.embeds_users) and \
+                (singular_values is not None or not updatable):
+            self.item_embeddings = item_embeddings
+            self.user_embeddings = user_embeddings
+            if updatable:
+                self.algo.restore(data, user_embeddings, singular_values, item_embeddings)
         else:
-            self.GetEmbeddings(data)
-            return self.item_embeddings
+            print("fitting algorithm %s with k=%g" % (self.algo.name, self.k))
+            self.algo.fit(data, self.k)
+            self.item_embeddings = save_artifact(self.store, key, "item_embeddings",
+                                                 self.algo.item_embeddings, self.dtype)
+            self.user_embeddings = save_artifact(self.store, key, "user_embeddings",
+                                                 self.algo.user_embeddings, self.dtype)
+            if updatable:
+                save_artifact(self.store, key, "singular_values", self.algo.singular_values,
+                              self.dtype)
+        self.embeddings_of = fingerprint
 
-    def GetUserEmbeddings(self, data):
-        if self.embeddings_of is not None and data.shape == self.embeddings_of.shape and \
-                (data.values == self.embeddings_of.values).all():
-            return self.user_embeddings
+    def UpdateEmbeddings(self, new_data, fingerprint, new_users_only=False):
+        # Update the fitted embeddings with new interactions instead of refitting, for algorithms
+        # that support it (see ItemsUsersSVDAlgo). fingerprint identifies the dataset that the
+        # updated embeddings represent, i.e. the fitted data along with new_data. With
+        # new_users_only, new users are folded in and the item embeddings, and therefore the
+        # item similarities, remain valid.
+        print("updating algorithm %s with k=%g on %g new interactions" %
+              (self.algo.name, self.k, len(new_data)))
+        if new_users_only:
+            self.algo.fold_in_users(new_data)
         else:
-            self.GetEmbeddings(data)
-            return self.user_embeddings
+            self.algo.partial_fit(new_data)
+        items_unchanged = new_users_only and \
+            self.algo.item_embeddings.shape == self.item_embeddings.shape
+        fitted_on = self.embeddings_of
+        self.item_embeddings = self.algo.item_embeddings.astype(self.dtype, copy=False)
+        self.user_embeddings = self.algo.user_embeddings.astype(self.dtype, copy=False)
+        self.embeddings_of = fingerprint
+        # item similarities and neighbors computed from the previous item embeddings stay valid
+        self.similarities_of = fingerprint if items_unchanged and \
+            self.similarities_of == fitted_on else None
+        self.item_knn_of = fingerprint if items_unchanged and \
+            self.item_knn_of == fitted_on else None
+
+    def GetItemEmbeddings(self, data, fingerprint=None):
+        fingerprint = dataset_fingerprint(data) if fingerprint is None else fingerprint
+        if self.embeddings_of != fingerprint:
+            self.GetEmbeddings(data, fingerprint)
+        return self.item_embeddings
+
+    def GetUserEmbeddings(self, data, fingerprint=None):
+        fingerprint = dataset_fingerprint(data) if fingerprint is None else fingerprint
+        if self.embeddings_of != fingerprint:
+            self.GetEmbeddings(data, fingerprint)
+        return self.user_embeddings
 
-    def GetItemSimilarities(self, data):
-        if self.similarities_of is not None and data.shape == self.similarities_of.shape and \
-                (data.values == self.similarities_of.values).all():
+    def GetItemSimilarities(self, data, fingerprint=None):
+        fingerprint = dataset_fingerprint(data) if fingerprint is None else fingerprint
+        if self.similarities_of == fingerprint:
             return self.item_similarities
+        key = artifact_key(self.store, self.algo, self.k, fingerprint, self.sim_func,
+                           self.dtype)
+        stored = load_artifact(self.store, key, "item_similarities")
+        if stored is not None:
+            self.item_similarities = stored
         else:
             print("calculating similarities by algorithm %s with k=%g and similarity function "
                   "%s" % (self.algo.name, self.k, self.sim_func.name))
-            self.item_similarities = self.sim_func(self.GetItemEmbeddings(data))
-            self.similarities_of = data
-            return self.item_similarities
+            self.item_similarities = save_artifact(
+                self.store, key, "item_similarities",
+                self.sim_func(self.GetItemEmbeddings(data, fingerprint)), self.dtype)
+        self.similarities_of = fingerprint
+        return self.item_similarities
+
+    def GetItemNeighbors(self, data, n, fingerprint=None):
+        # see ItemSimilarityModel.GetItemNeighbors
+        fingerprint = dataset_fingerprint(data) if fingerprint is None else fingerprint
+        if self.item_knn_of != fingerprint or n > self.knn_size:
+            self.knn_size = max(self.knn_size, n)
+            self.item_knn = get_item_knn(self.store, self.algo, self.k, fingerprint,
+                                         self.sim_func, self.GetItemEmbeddings(data, fingerprint),
+                                         self.knn_size, self.dtype)
+            self.item_knn_of = fingerprint
+            if self.drop_similarities:
+                self.item_similarities = None
+                self.similarities_of = None
+        nearest_items, similarities = self.item_knn
+        return nearest_items[:, :n], similarities[:, :n]
+
+
+def get_item_knn(store, algo, k, fingerprint, sim_func, item_embeddings, knn_size,
+                 dtype=np.float64):
+    # The item-kNN table: int32 ids and float32 similarities of the knn_size nearest items of
+    # every item, ordered by descending similarity. It is computed in blocks of items by the
+    # similarity function's nearest_neighbors, without the dense similarity matrix.
+    key = artifact_key(store, algo, k, fingerprint, sim_func, dtype, knn_size=knn_size)
+    nearest_items = load_artifact(store, key, "item_knn_ids")
+    similarities = load_artifact(store, key, "item_knn_similarities")
+    if nearest_items is None or similarities is None:
+        print("calculating %g nearest items by algorithm %s with k=%g and similarity function "
+              "%s" % (knn_size, algo.name, k, sim_func.name))
+        nearest_items, similarities = sim_func.nearest_neighbors(item_embeddings, knn_size)
+        nearest_items = save_artifact(store, key, "item_knn_ids",
+                                      nearest_items.astype(np.int32))
+        similarities = save_artifact(store, key, "item_knn_similarities",
+                                     similarities.astype(np.float32))
+    return nearest_items, similarities
+
+
+def artifact_key(store, algo, k, fingerprint, sim_func=None, dtype=np.float64, **params):
+    # params holds parameters of the artifact itself, beyond those of the algorithm
+    if store is None:
+        return None
+    params = dict(algo.get_params(), k=k, dtype=np.dtype(dtype).name, **params)
+    if sim_func is not None:
+        params["sim_func"] = sim_func.name
+        # e.g. the index settings of an approximate search, which change the neighbors found.
+        # Functions without parameters keep the keys of their stored artifacts.
+        if len(sim_func.get_params()) > 0:
+            params["sim_func_params"] = sim_func.get_params()
+    return store.key(algo.name, params, fingerprint)
+
+
+def load_artifact(store, key, name):
+    return None if store is None else store.load(key, name)
+
+
+def save_artifact(store, key, name, array, dtype=None):
+    # arrays that an algorithm does not produce (e.g. user embeddings of an items-only
+    # algorithm) are not stored. Arrays are cast to dtype, if given.
+    if array is not None and dtype is not None:
+        array = np.asarray(array).astype(dtype, copy=False)
+    if store is None or array is None:
+        return array
+    return store.save(key, name, array)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+
+class ArtifactStore:
+    # An on-disk store for fitted arrays (embeddings, similarity matrices) that are expensive to
+    # recompute. Artifacts are grouped by a key derived from the algorithm name, its
+    # hyperparameters and the fingerprint of the dataset it was fitted on (see
+    # DataHandler.getFingerprint). Each group is a directory holding one .npy file per array.
+    #
+    # Arrays are loaded memory-mapped and read-only, so later runs and other worker processes
+    # share the pages of the OS file cache instead of holding private copies. When max_bytes is
+    # set, the least recently used groups are evicted once the store grows beyond it.
+    #
+    # Each group also holds a description.json of the algorithm, hyperparameters and
+    # fingerprint that its key was derived from, so that the store can be inspected.
+
+    def __init__(self, root="../artifacts", max_bytes=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        # descriptions of the keys derived by this store, written along with their artifacts
+        self.descriptions = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def key(self, algo_name, params, fingerprint):
+        description = json.dumps({"algo": algo_name, "params": params,
+                                  "fingerprint": fingerprint}, sort_keys=True, default=str)
+        key = hashlib.sha1(description.encode()).hexdigest()
+        self.descriptions[key] = description
+        return key
+
+    def load(self, key, name):
+        path = self._array_path(key, name)
+        if not os.path.exists(path):
+            return None
+        self._touch(key)
+        return np.load(path, mmap_mode="r")
+
+    def save(self, key, name, array):
+        directory = os.path.join(self.root, key)
+        os.makedirs(directory, exist_ok=True)
+        description_path = os.path.join(directory, "description.json")
+        if key in self.descriptions and not os.path.exists(description_path):
+            with open(description_path, "w") as f:
+                f.write(self.descriptions[key])
+
+        # write to a temporary file and rename it, so that concurrent readers never see a
+        # partially written array
+        temp_path = os.path.join(directory, "%s.%s.tmp" % (name, uuid.uuid4().hex))
+        with open(temp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(array))
+        os.replace(temp_path, self._array_path(key, name))
+        self._touch(key)
+
+        if self.max_bytes is not None:
+            self.evict(keep=key)
+        return self.load(key, name)
+
+    def evict(self, keep=None):
+        # delete the least recently used groups until the store fits in max_bytes
+        groups = []
+        for key in os.listdir(self.root):
+            directory = os.path.join(self.root, key)
+            if not os.path.isdir(directory):
+                continue
+            size = sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+            groups.append((os.path.getmtime(directory), size, key))
+
+        total_size = sum(size for _, size, _ in groups)
+        for _, size, key in sorted(groups):
+            if total_size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            total_size -= size
+
+    def _array_path(self, key, name):
+        return os.path.join(self.root, key, name + ".npy")
+
+    def _touch(self, key):
+        # the modification time of a group's directory records its last use
+        os.utime(os.path.join(self.root, key))
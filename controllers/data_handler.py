@@ -1,7 +1,31 @@
+import hashlib
+import os
 import warnings
 import pandas as pd
 import numpy as np
 import json
+from scipy.sparse import csr_matrix
+
+# numeric representations of the pipeline. "single" precision halves memory and bandwidth on the
+# similarity-heavy paths: user and item indices are int32, labels int8 and embeddings,
+# similarities and scores float32.
+PRECISIONS = {"double": {"index": np.int64, "label": np.int64, "float": np.float64},
+              "single": {"index": np.int32, "label": np.int8, "float": np.float32}}
+
+
+class UnknownTemplate:
+    # marker of templates that have no entry in the templates metadata. There is a single
+    # instance, UNKNOWN_TEMPLATE, which unpickles to itself so that it can be compared with "is"
+    # in worker processes.
+
+    def __repr__(self):
+        return "UNKNOWN_TEMPLATE"
+
+    def __reduce__(self):
+        return "UNKNOWN_TEMPLATE"
+
+
+UNKNOWN_TEMPLATE = UnknownTemplate()
 
 
 class DataHandler:
@@ -9,30 +33,65 @@ class DataHandler:
     def __init__(self, data_specs):
         data_specs["variants"] = [""] if "variants" not in data_specs.keys() else \
             data_specs["variants"]
+        data_specs["precision"] = "double" if "precision" not in data_specs.keys() else \
+            data_specs["precision"]
+        if data_specs["precision"] not in PRECISIONS.keys():
+            raise ValueError("unknown precision " + data_specs["precision"])
         self.data_specs = data_specs
+        self.dtypes = PRECISIONS[data_specs["precision"]]
         self.data, self.users_map, self.items_map = self.LoadData(data_specs)
         self.metadata, self.thumbnails_path = self.LoadMetadata(data_specs)
         self.json_configuration_field = "jsonConfigurationName" if \
             data_specs["project_name"] == "story" else "configuration"
-        self.LOO_data = {"usage_data": None, "left_out": pd.DataFrame()}
+        self.metadata_index = self.build_metadata_index()
+        self.item_categories, self.item_thumbnails = self.build_item_metadata()
+        self.category_matrix, self.category_names = self.build_category_matrix()
+        # held-out datasets (e.g. "LOO"), each holding the obfuscated usage data and the
+        # left-out items
+        self.holdout_data = {}
+        self.activity_index = {"all": self.build_activity_index(self.data,
+                                                                self.LoadOffsets(data_specs))}
+        self.fingerprints = {"all": dataset_fingerprint(self.data)}
+        self.popularity_ranks = None
 
     def getData(self, dataset):
         if dataset == "all":
             return self.data
-        elif dataset == "LOO":
-            return self.LOO_data["usage_data"]
+        elif dataset in self.holdout_data.keys():
+            return self.holdout_data[dataset]["usage_data"]
+        else:
+            raise ValueError("unknown dataset " + dataset)
+
+    def getLeftOut(self, dataset):
+        if dataset not in self.holdout_data.keys():
+            raise ValueError("unknown dataset " + dataset)
+        return self.holdout_data[dataset]["left_out"]["template_index"].values
+
+    def dropDataset(self, dataset):
+        # release a held-out dataset and its indices
+        if dataset in self.holdout_data.keys():
+            del self.holdout_data[dataset]
+            del self.activity_index[dataset]
+            del self.fingerprints[dataset]
+
+    def getFingerprint(self, dataset):
+        if dataset not in self.fingerprints.keys():
+            raise ValueError("unknown dataset " + dataset)
+        return self.fingerprints[dataset]
 
     def getItemCategories(self, item):
         if type(item) != str and type(item) != np.str_:
-            item = self.getItemName([[item]])[0][0]
-        variant = item.split("-")[-1]
-        variant = variant if variant in self.metadata.keys() else ""
-        metadata = self.metadata[variant]
-        for dat in metadata:
-            if dat[self.json_configuration_field] == item:
-                return dat["templateCategories"]
+            categories = self.item_categories[item]
+        else:
+            dat = self.getItemMetadata(item)
+            categories = UNKNOWN_TEMPLATE if dat is None else dat["templateCategories"]
         # in case a configuration is not in the json file
-        return []
+        return [] if categories is UNKNOWN_TEMPLATE else list(categories)
+
+    def getCategoryMatrix(self):
+        # sparse binary (templates x categories) matrix; the categories of its columns are
+        # self.category_names
+        return self.category_matrix
 
     def getItemName(self, item_ids):
         item_names = []
@@ -42,65 +101,195 @@ class DataHandler:
 
     def getItemThumbnailPath(self, item):
         if type(item) != str and type(item) != np.str_:
-            item = self.getItemName([[item]])[0][0]
-        variant = item.split("-")[-1]
-        variant = variant if variant in self.metadata.keys() else ""
-        metadata = self.metadata[variant]
-        for dat in metadata:
-            if dat[self.json_configuration_field] == item:
-                return self.thumbnails_path + dat["templateThumbnail"]
+            thumbnail = self.item_thumbnails[item]
+            return None if thumbnail is UNKNOWN_TEMPLATE else thumbnail
+        dat = self.getItemMetadata(item)
+        return None if dat is None else self.thumbnails_path + dat["templateThumbnail"]
+
+    def getItemMetadata(self, item_name):
+        # the metadata entry of a configuration name, or None if it is not in the json file
+        variant = item_name.split("-")[-1]
+        variant = variant if variant in self.metadata_index.keys() else ""
+        return self.metadata_index[variant].get(item_name)
+
+    def isKnownItem(self, item):
+        # whether a template index has an entry in the metadata
+        return self.item_categories[item] is not UNKNOWN_TEMPLATE
+
+    def build_metadata_index(self):
+        # dictionary from configuration name to metadata entry for each variant. The first
+        # entry of a configuration is used, as in a scan of the json file.
+        metadata_index = {}
+        for variant, metadata in self.metadata.items():
+            entries = {}
+            for dat in metadata:
+                entries.setdefault(dat[self.json_configuration_field], dat)
+            metadata_index[variant] = entries
+        return metadata_index
+
+    def build_item_metadata(self):
+        # dense arrays, indexed by template index, of the categories (a tuple, in the order of
+        # the json file) and the thumbnail path of each template, built once at load time.
+        # Templates that are not in the json file are marked UNKNOWN_TEMPLATE in both arrays.
+        item_names = self.items_map.iloc[:, 1].values
+        item_categories = np.full(len(item_names), UNKNOWN_TEMPLATE, dtype=object)
+        item_thumbnails = np.full(len(item_names), UNKNOWN_TEMPLATE, dtype=object)
+        for item, item_name in enumerate(item_names):
+            dat = self.getItemMetadata(item_name)
+            if dat is not None:
+                item_categories[item] = tuple(dat["templateCategories"])
+                item_thumbnails[item] = self.thumbnails_path + dat["templateThumbnail"]
+        return item_categories, item_thumbnails
+
+    def build_category_matrix(self):
+        # templates that are not in the json file have no categories, and a category listed
+        # more than once for a template is counted once
+        item_categories = [() if categories is UNKNOWN_TEMPLATE else
+                           tuple(dict.fromkeys(categories)) for categories in self.item_categories]
+        category_names = sorted(frozenset().union(*item_categories))
+        category_columns = {category: j for j, category in enumerate(category_names)}
+        indptr = np.zeros(len(item_categories) + 1, dtype=int)
+        np.cumsum([len(categories) for categories in item_categories], out=indptr[1:])
+        columns = np.array([category_columns[category] for categories in item_categories
+                            for category in categories], dtype=int)
+        category_matrix = csr_matrix((np.ones(len(columns)), columns, indptr),
+                                     shape=(len(item_categories), len(category_names)))
+        return category_matrix, category_names
 
     def getNumItems(self, dataset="all"):
         if dataset == "all":
             return self.items_map.template_index.max() + 1
-        if dataset == "LOO":
-            item_indices = np.unique(self.LOO_data["usage_data"].template_index.values)
-            if item_indices.max() + 1 > len(item_indices):
-                warnings.warn("Some items are not represented in the LOO train set. \n"
-                              "These missing items may be recommended upon by Usage-independent "
-                              "recommenders.")
-            return item_indices.max() + 1
+        item_indices = np.unique(self.getData(dataset).template_index.values)
+        if item_indices.max() + 1 > len(item_indices):
+            warnings.warn("Some items are not represented in the %s train set. \n"
+                          "These missing items may be recommended upon by Usage-independent "
+                          "recommenders." % dataset)
+        return item_indices.max() + 1
 
-    def getUsage(self, user_ids):
-        return self.data.loc[self.data.user_index.isin(user_ids)]
+    def getPopularityRanks(self):
+        # popularity rank of each item in the full dataset: the least popular item has rank 0,
+        # the next least popular 1 and so on, the most popular N - 1 (N being the number of
+        # items). Computed once.
+        if self.popularity_ranks is None:
+            counts = np.bincount(self.data.template_index.values, minlength=self.getNumItems())
+            order = np.argsort(counts)
+            self.popularity_ranks = np.empty_like(order)
+            self.popularity_ranks[order] = np.arange(len(order))
+        return self.popularity_ranks
 
-    def getUserActivity(self, user_id, dataset="all"):
-        if dataset == "all":
-            return self.data.loc[self.data.user_index == user_id,
-                                 ["template_index", "is_selected"]].values
-        elif dataset == "LOO":
-            return self.LOO_data["usage_data"].loc[self.LOO_data["usage_data"].
-                                                   user_index == user_id,
-                                                   ["template_index", "is_selected"]].values
-        else:
+    def getActivityIndex(self, dataset="all"):
+        if dataset not in self.activity_index.keys():
             raise ValueError("unknown dataset " + dataset)
+        return self.activity_index[dataset]
+
+    def getUsage(self, user_ids, dataset="all"):
+        index = self.getActivityIndex(dataset)
+        rows = np.sort(index["rows"][self._activity_positions(index, user_ids)[1]])
+        return self.getData(dataset).iloc[rows]
+
+    def getUserActivity(self, user_id, dataset="all"):
+        index = self.getActivityIndex(dataset)
+        start, end = self._activity_bounds(index, user_id)
+        return np.column_stack((index["items"][start:end], index["labels"][start:end]))
+
+    def getUsersActivity(self, user_ids, dataset="all"):
+        # CSR slice of the activity index for a batch of users: the activity of user_ids[i] is
+        # items[indptr[i]:indptr[i + 1]] with labels at the same positions
+        index = self.getActivityIndex(dataset)
+        indptr, positions = self._activity_positions(index, user_ids)
+        return indptr, index["items"][positions], index["labels"][positions]
 
-    def getUserActivitySplit(self, user_id):
-        user_previews = self.getUserActivity(user_id)
-        selected = user_previews[np.where(user_previews[:, 1] == 1), 0]
-        unselected = user_previews[np.where(user_previews[:, 1] == 0), 0]
-        return selected.squeeze(0), unselected.squeeze(0)
+    def getUserActivitySplit(self, user_id, dataset="all"):
+        index = self.getActivityIndex(dataset)
+        start, end = self._activity_bounds(index, user_id)
+        items = index["items"][start:end]
+        labels = index["labels"][start:end]
+        return items[labels == 1], items[labels == 0]
 
     def getUserIds(self, dataset="all"):
-        if dataset == "all":
-            return self.data.user_index.unique()
-        elif dataset == "LOO":
-            return self.LOO_data["usage_data"].user_index.unique()
-        else:
-            raise ValueError("unknown dataset " + dataset)
+        return self.getData(dataset).user_index.unique()
+
+    def build_activity_index(self, data, indptr=None):
+        # CSR-style index of a usage dataset: the activity of user u is held in
+        # items[indptr[u]:indptr[u + 1]] and labels[indptr[u]:indptr[u + 1]], and rows holds the
+        # positions of these interactions in the original DataFrame. Rows of each user keep their
+        # order of appearance in the data.
+        # indptr may hold precomputed offsets of data that is sorted by user (see
+        # LoadOffsets), in which case the index is a view of the data columns.
+        if indptr is not None:
+            return {"indptr": indptr,
+                    "items": data.template_index.values,
+                    "labels": data.is_selected.values,
+                    "rows": np.arange(len(data))}
+        user_index = data.user_index.values
+        order = np.argsort(user_index, kind="stable")
+        counts = np.bincount(user_index) if len(user_index) > 0 else np.zeros(0, dtype=int)
+        indptr = np.zeros(len(counts) + 1, dtype=int)
+        np.cumsum(counts, out=indptr[1:])
+        return {"indptr": indptr,
+                "items": data.template_index.values[order],
+                "labels": data.is_selected.values[order],
+                "rows": order}
+
+    @staticmethod
+    def _activity_bounds(index, user_id):
+        # users beyond the last indexed user have no activity
+        if user_id < 0 or user_id + 1 >= len(index["indptr"]):
+            return 0, 0
+        return index["indptr"][user_id], index["indptr"][user_id + 1]
+
+    @staticmethod
+    def _activity_positions(index, user_ids):
+        # positions in the activity index of the interactions of all given users, grouped by user
+        # in the order of user_ids, along with the offsets of each user's group
+        user_ids = np.asarray(user_ids, dtype=int)
+        indexed = (user_ids >= 0) & (user_ids + 1 < len(index["indptr"]))
+        clipped = np.where(indexed, user_ids, 0)
+        starts = np.where(indexed, index["indptr"][clipped], 0)
+        lengths = np.where(indexed, index["indptr"][clipped + 1], 0) - starts
+        indptr = np.zeros(len(user_ids) + 1, dtype=int)
+        np.cumsum(lengths, out=indptr[1:])
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        return indptr, positions
 
     def LoadData(self, dataspecs):
+        # datasets that have a binary copy (see to_recsys_format) are loaded memory-mapped
+        binary_path = binary_data_path(dataspecs)
+        if os.path.isdir(binary_path):
+            return self.LoadBinaryData(binary_path, dataspecs["precision"])
+
         data_path = "../data/RecSys data/" + dataspecs["project_name"] + "/" + \
                     dataspecs["data_name"] + ".csv"
         users_map_path = "../data/processing/" + dataspecs["project_name"] + "/" + \
                          dataspecs["data_name"] + " users_map"
         items_map_path = "../data/processing/" + dataspecs["project_name"] + "/" + \
                          dataspecs["data_name"] + " templates_map"
-        data = pd.read_csv(data_path)
+        data = pd.read_csv(data_path, dtype=usage_dtypes(dataspecs["precision"]))
         users_map = pd.read_csv(users_map_path)
         items_map = pd.read_csv(items_map_path)
         return data, users_map, items_map
 
+    def LoadBinaryData(self, binary_path, precision):
+        # The usage columns are read-only memory maps, shared through the OS file cache by all
+        # processes that load the dataset. They are stored as int32 indices and int8 labels,
+        # which the single precision mode uses as is, while other precisions get a copy.
+        data = pd.DataFrame({column: np.load(os.path.join(binary_path, column + ".npy"),
+                                             mmap_mode="r")
+                             for column in ["user_index", "template_index", "is_selected"]},
+                            copy=False).astype(usage_dtypes(precision), copy=False)
+        id_for_vendor = np.load(os.path.join(binary_path, "id_for_vendor.npy"))
+        template_name = np.load(os.path.join(binary_path, "template_name.npy"))
+        users_map = pd.DataFrame({"user_index": np.arange(len(id_for_vendor)),
+                                  "id_for_vendor": id_for_vendor})
+        items_map = pd.DataFrame({"template_index": np.arange(len(template_name)),
+                                  "template_name": template_name})
+        return data, users_map, items_map
+
+    def LoadOffsets(self, dataspecs):
+        # the per-user offsets of the binary copy of the dataset, if there is one
+        path = os.path.join(binary_data_path(dataspecs), "indptr.npy")
+        return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
     def LoadMetadata(self, dataspecs):
         thumbnails_path = "../data/templates metadata/" + \
                           dataspecs["project_name"] + "/thumbnails/"
@@ -115,36 +304,113 @@ class DataHandler:
 
         return metadata, thumbnails_path
 
-    def prepare_LOO_dataset(self):
-        # for each user in the data, randomly remove one selected item. If the user has no items
-        # labeled as selected, discard the user. Return the obfuscated dataset and list of the
-        # left-out items.
+    def prepare_LOO_dataset(self, seed=None, dataset="LOO"):
+        # for each user in the data, randomly remove one selected item. If the user has less than
+        # two items labeled as selected, discard the user. Return the obfuscated dataset and list
+        # of the left-out items, ordered by user index.
         # Optional: Hold a map that transforms user's index from LOO-dataset to 'all'.
+        #
+        # Several splits may be held at once under different dataset names, e.g. for repeated
+        # evaluation with different seeds. An existing dataset is reused unless a different seed
+        # is given, in which case it is drawn again; without a seed, any existing draw is reused.
 
-        def loo(user_previews):
-            this_user = user_previews.user_index.iloc[0]
-            selected = user_previews.loc[user_previews.is_selected == 1]
-            if len(selected) < 2:
-                return pd.DataFrame()
-            else:
-                to_remove = selected.iloc[np.random.randint(len(selected))].template_index
-                removed_items.append({"user_index": this_user, "template_index": to_remove})
-                return user_previews[user_previews.template_index != to_remove]
-
-        removed_items = []
-        # for i in range(3):
-        #     print("!!! USING 1000 DATA LINES FOR CODE TESTING !!!")
-        # self.data = self.data.iloc[:7000]
-        users_split = self.data.groupby(by="user_index")
-
-        if self.LOO_data["usage_data"] is None:
+        split = ("LOO", seed)
+        if not self.holds_split(dataset, split, seed is None):
             print("Constructing LOO dataset and left-out test set")
-            LOO_data = users_split.apply(loo)
+            random_state = np.random.RandomState(seed)
+
+            def pick(num_selected):
+                return (random_state.random_sample(len(num_selected)) * num_selected).astype(int)
+
+            self.hold_out(dataset, split, pick)
+
+        return self.getData(dataset), self.getLeftOut(dataset)
+
+    def prepare_fold_dataset(self, fold, n_folds, seed=0, dataset=None):
+        # K-fold variant of the LOO split: the selected items of each user are shuffled once
+        # (by seed), and fold f leaves out the item in position f of the shuffled order (modulo
+        # the number of selected items). Users with at least n_folds selected items thus have a
+        # different item left out in each fold. Users with less than two selected items are
+        # discarded, as in the LOO split.
+        dataset = "fold %g/%g" % (fold, n_folds) if dataset is None else dataset
+
+        split = ("fold", fold, n_folds, seed)
+        if not self.holds_split(dataset, split):
+            print("Constructing fold %g of %g and left-out test set" % (fold, n_folds))
+            shuffle_keys = np.random.RandomState(seed).random_sample(len(self.data))
+
+            def pick(num_selected):
+                return fold % num_selected
+
+            self.hold_out(dataset, split, pick, shuffle_keys)
+
+        return self.getData(dataset), self.getLeftOut(dataset)
+
+    def holds_split(self, dataset, split, any_split=False):
+        # whether the held-out dataset exists and was drawn as split (or, with any_split, exists)
+        return dataset in self.holdout_data.keys() and \
+            (any_split or self.holdout_data[dataset]["split"] == split)
+
+    def hold_out(self, dataset, split, pick, shuffle_keys=None):
+        # Leave one selected item out for every user with at least two selected items and
+        # register the result as a held-out dataset, along with split, the parameters it was
+        # drawn with (see holds_split). pick(num_selected) gets the number of selected items of
+        # each such user and returns the position of the item to leave out among them. Selected
+        # items are in order of appearance in the data, or shuffled by shuffle_keys (one key per
+        # row of the data).
+        #
+        # The split is computed in one pass over the activity index, in which the interactions
+        # are grouped by user: the selected interactions of each user are contiguous, so picking
+        # one of them is an offset into the user's group.
+        index = self.getActivityIndex("all")
+        items, labels = index["items"], index["labels"]
+        users = np.repeat(np.arange(len(index["indptr"]) - 1), np.diff(index["indptr"]))
+
+        selected = np.nonzero(labels == 1)[0]
+        if shuffle_keys is not None:
+            selected = selected[np.lexsort((shuffle_keys[index["rows"][selected]],
+                                            users[selected]))]
+        num_selected = np.bincount(users[selected], minlength=len(index["indptr"]) - 1)
+        selected_offsets = np.cumsum(num_selected) - num_selected
+        eligible_users = np.nonzero(num_selected >= 2)[0]
+        removed = selected[selected_offsets[eligible_users] + pick(num_selected[eligible_users])]
+
+        removed_item_of_user = np.full(len(num_selected), -1)
+        removed_item_of_user[eligible_users] = items[removed]
+        keep = (num_selected[users] >= 2) & (items != removed_item_of_user[users])
+
+        usage_data = pd.DataFrame({"user_index": users[keep],
+                                   "template_index": items[keep],
+                                   "is_selected": labels[keep]}).astype(
+            usage_dtypes(self.data_specs["precision"]))
+        self.holdout_data[dataset] = {
+            "split": split,
+            "usage_data": usage_data,
+            "left_out": pd.DataFrame({"user_index": eligible_users,
+                                      "template_index": items[removed]})}
+        self.activity_index[dataset] = self.build_activity_index(usage_data)
+        self.fingerprints[dataset] = dataset_fingerprint(usage_data)
+
+
+def binary_data_path(dataspecs):
+    return "../data/RecSys data/" + dataspecs["project_name"] + "/" + dataspecs["data_name"]
+
+
+def usage_dtypes(precision):
+    # column dtypes of a usage dataset in the given precision
+    dtypes = PRECISIONS[precision]
+    return {"user_index": dtypes["index"], "template_index": dtypes["index"],
+            "is_selected": dtypes["label"]}
 
-            self.LOO_data["usage_data"] = LOO_data.reset_index(drop=True).astype(int)
-            self.LOO_data["left_out"] = pd.DataFrame(removed_items[1:])
 
-        return self.LOO_data["usage_data"], self.LOO_data["left_out"]["template_index"].values
+def dataset_fingerprint(data):
+    # content hash of a usage dataset. Models fitted on a dataset key their caches on it instead
+    # of holding and comparing a copy of the data.
+    digest = hashlib.sha1()
+    for column in ["user_index", "template_index", "is_selected"]:
+        digest.update(np.ascontiguousarray(data[column].values).tobytes())
+        digest.update(b"|")
+    return digest.hexdigest()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,276 @@
+import asyncio
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+
+class MicroBatcher:
+    # Coalesces concurrent requests into batches for a vectorized function. A batch is started
+    # by the first waiting request and collects further requests for up to max_wait seconds or
+    # until it holds max_batch_size requests. batch_function(subjects, n) returns one row of n
+    # results per subject; each request gets the first n of its row, which for top-n rankings
+    # is the request's own top n. Batches run one at a time on a worker thread, so the event
+    # loop keeps accepting requests while a batch is scored.
+
+    def __init__(self, batch_function, max_batch_size=256, max_wait=0.002):
+        self.batch_function = batch_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = asyncio.Queue()
+        self.batch_sizes = collections.deque(maxlen=10000)
+
+    async def submit(self, subject, n):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((subject, n, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batch_sizes.append(len(batch))
+
+            subjects = [subject for subject, _, _ in batch]
+            n = max(n for _, n, _ in batch)
+            try:
+                results = await loop.run_in_executor(self.executor, self.batch_function,
+                                                     subjects, n)
+            except Exception as error:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+            for (_, n, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result[:n])
+
+
+class RecommendationServer:
+    # A long-lived HTTP service around a fitted recommender. The model (and its item-kNN table)
+    # is fitted or loaded once by warm(), and concurrent requests are served from memory through
+    # micro-batches of the recommender's vectorized recommend_for_users and recommend_for_items.
+    # Endpoints (responses are JSON):
+    #   GET /recommend/user?id=<user index>&n=<count>  recommended items for a user
+    #   GET /recommend/item?id=<item index>&n=<count>  nearest items of an item
+    #   GET /stats                                     latency percentiles and batch sizes
+    # Unknown users (without usage data) and items get a 404 response.
+    # Latency is measured from the parsed request to the written response.
+
+    def __init__(self, recommender, default_n=10, max_n=100, max_batch_size=256,
+                 max_wait=0.002):
+        self.recommender = recommender
+        self.data_handler = recommender.data_handler
+        self.default_n = default_n
+        # at most all items can be recommended
+        self.max_n = min(max_n, self.data_handler.getNumItems())
+        # users with usage data, the only ones that can be recommended for
+        self.known_users = np.zeros(self.data_handler.users_map.user_index.max() + 1, dtype=bool)
+        self.known_users[self.data_handler.getUserIds()] = True
+        self.batchers = {
+            "user": MicroBatcher(lambda users, n: recommender.recommend_for_users(users, n),
+                                 max_batch_size, max_wait),
+            "item": MicroBatcher(lambda items, n: recommender.recommend_for_items(items, n)[0],
+                                 max_batch_size, max_wait)}
+        self.latencies = collections.deque(maxlen=10000)
+        # the running batchers, held so that they are not garbage collected
+        self.tasks = []
+
+    def warm(self):
+        # fit or load the model and its item-kNN table before the first request
+        print("warming up the recommender")
+        self.recommender.recommend_for_users(np.arange(1), self.max_n)
+        self.recommender.recommend_for_items(np.arange(1), self.max_n)
+
+    async def serve(self, host="127.0.0.1", port=8080):
+        server = await self.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.stop()
+
+    async def start(self, host="127.0.0.1", port=8080):
+        self.warm()
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(batcher.run()) for batcher in self.batchers.values()]
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print("serving recommendations on http://%s:%g" % (host, port))
+        return server
+
+    def stop(self):
+        # stop the batchers started by start
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    async def handle_connection(self, reader, writer):
+        # HTTP/1.1 with persistent connections, one request at a time per connection
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                start = time.perf_counter()
+                parts = request_line.decode("latin-1").split()
+                if len(parts) != 3:
+                    status, body = 400, {"error": "malformed request line"}
+                else:
+                    status, body = await self.route(parts[0], parts[1])
+                write_response(writer, status, body)
+                await writer.drain()
+                self.latencies.append(time.perf_counter() - start)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method, target):
+        url = urlsplit(target)
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        if method != "GET":
+            return 405, {"error": "only GET is supported"}
+        if url.path == "/stats":
+            return 200, self.stats()
+        if url.path not in ["/recommend/user", "/recommend/item"]:
+            return 404, {"error": "unknown path " + url.path}
+
+        kind = url.path.split("/")[-1]
+        try:
+            subject = int(params["id"])
+            n = int(params.get("n", self.default_n))
+        except (KeyError, ValueError):
+            return 400, {"error": "id and n must be integers"}
+        if not 0 < n <= self.max_n:
+            return 400, {"error": "n out of range"}
+        num_subjects = len(self.known_users) if kind == "user" else \
+            self.data_handler.getNumItems()
+        if not 0 <= subject < num_subjects or (kind == "user" and not self.known_users[subject]):
+            return 404, {"error": "unknown %s %d" % (kind, subject)}
+
+        try:
+            items = await self.batchers[kind].submit(subject, n)
+        except Exception as error:
+            return 500, {"error": repr(error)}
+        return 200, {kind: subject, "items": np.asarray(items).tolist(),
+                     "names": self.data_handler.getItemName([items])[0].tolist()}
+
+    def stats(self):
+        stats = {"requests": len(self.latencies)}
+        stats.update(latency_percentiles(self.latencies))
+        for kind, batcher in self.batchers.items():
+            if len(batcher.batch_sizes) > 0:
+                stats["mean %s batch size" % kind] = float(np.mean(batcher.batch_sizes))
+        return stats
+
+
+def write_response(writer, status, body):
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               500: "Internal Server Error"}
+    payload = json.dumps(body).encode()
+    writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+                  "\r\n" % (status, reasons[status], len(payload))).encode() + payload)
+
+
+def latency_percentiles(latencies):
+    # p50 and p99 of latencies in seconds, reported in milliseconds
+    if len(latencies) == 0:
+        return {}
+    p50, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 99])
+    return {"p50_ms": p50, "p99_ms": p99}
+
+
+async def load_test(host, port, subjects, n=10, kind="user", n_requests=10000, concurrency=64,
+                    seed=0):
+    # Local load generator: concurrency clients, each on its own persistent connection, send
+    # n_requests requests in total for random subjects (user or item indices) and time them.
+    # Returns the p50 and p99 client-side latencies and the throughput.
+    random_state = np.random.RandomState(seed)
+    requested = random_state.choice(subjects, n_requests)
+    latencies = []
+
+    async def client(requests):
+        reader, writer = await asyncio.open_connection(host, port)
+        for subject in requests:
+            start = time.perf_counter()
+            writer.write(("GET /recommend/%s?id=%d&n=%d HTTP/1.1\r\nHost: %s\r\n\r\n" %
+                          (kind, subject, n, host)).encode())
+            await writer.drain()
+            await reader.readline()
+            content_length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    content_length = int(value)
+            await reader.readexactly(content_length)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(requests)
+                           for requests in np.array_split(requested, concurrency)])
+    duration = time.perf_counter() - start
+
+    report = latency_percentiles(latencies)
+    report["requests_per_second"] = n_requests / duration
+    print("%g %s requests with %g concurrent clients: p50 %.2f ms, p99 %.2f ms, %.0f "
+          "requests/s" % (n_requests, kind, concurrency, report["p50_ms"], report["p99_ms"],
+                          report["requests_per_second"]))
+    return report
+
+
+if __name__ == "__main__":
+    import sys
+    from controllers.data_handler import DataHandler
+    from controllers.artifact_store import ArtifactStore
+    from algorithms.RecSysAlgo import ItemsSVDAlgo
+    from similarity_functions.SimFunc import CosineSimilarity
+    from recommendation.Recommender import ItemSimilarityRecommender
+
+    data_specs = {"project_name": "story", "data_name": "min_previews 5",
+                  "precision": "single"}
+    dh = DataHandler(data_specs)
+    recommender = ItemSimilarityRecommender(dh, ItemsSVDAlgo(replace_zero_by=-1), 10,
+                                            CosineSimilarity, {"0": -1, "1": 1},
+                                            store=ArtifactStore())
+    server = RecommendationServer(recommender)
+
+    async def serve_and_load_test():
+        # serve in-process and exercise the server with the load generator
+        try:
+            async with await server.start("127.0.0.1", 8080):
+                await load_test("127.0.0.1", 8080, dh.getUserIds())
+                await load_test("127.0.0.1", 8080, np.arange(dh.getNumItems()), kind="item")
+        finally:
+            server.stop()
+
+    if "--load-test" in sys.argv:
+        asyncio.run(serve_and_load_test())
+    else:
+        asyncio.run(server.serve("127.0.0.1", 8080))
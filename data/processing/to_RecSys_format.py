@@ -1,75 +1,225 @@
-import pandas as pd
+import os
+import shutil
+import tempfile
 from os import makedirs
-pd.set_option('display.max_columns', None)
 
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+pd.set_option('display.max_columns', None)
 
-def to_recsys_format(project_name, min_previews, variant=None):
-    print("creating dataset for project %s\nwith min_previews %g\nfor variant %s" %
-          (project_name, min_previews, str(variant)))
+# templates of the non-US variants are suffixed with "-ch" or "-ja"
+NON_US_VARIANTS = ["ch", "ja"]
+
+# columns of the binary copy of a dataset and their dtypes
+BINARY_COLUMNS = {"user_index": np.int32, "template_index": np.int32, "is_selected": np.int8}
+
+
+def to_recsys_format(project_name, min_previews, variant=None, chunk_size=10 ** 6,
+                     n_partitions=16, temp_dir=None):
+    build_datasets(project_name, [min_previews], [variant], chunk_size, n_partitions, temp_dir)
+
+
+def build_datasets(project_name, min_previews_values, variants, chunk_size=10 ** 6,
+                   n_partitions=16, temp_dir=None):
+    # Build the dataset of every combination of a variant and a min_previews threshold in a
+    # single pass over the raw export. The raw export is streamed in chunks of chunk_size rows,
+    # so that exports larger than memory can be processed:
+    # 1. the rows of each chunk are reduced to one row per user-template event and appended to
+    #    one of n_partitions partition files by a hash of the user, so that all events of a user
+    #    are in the same partition. With a single variant, rows of other variants are dropped
+    #    here.
+    # 2. each partition is aggregated in memory, once for all datasets, and the number of events
+    #    of each user in each variant is counted. A dataset keeps the events of its variant of
+    #    users with at least min_previews events in it, and its index maps are built
+    #    incrementally from the users and templates that it keeps.
+    # 3. the output of every dataset is written sorted by user index by an external bucket sort
+    # Memory is thus bounded by the size of a chunk, of a partition and of the index maps.
+    # Intermediate files are written to a directory created in temp_dir (by default, the
+    # system's temporary directory).
+    datasets = [(min_previews, v) for v in range(len(variants))
+                for min_previews in min_previews_values]
+    for min_previews, v in datasets:
+        print("creating dataset for project %s\nwith min_previews %g\nfor variant %s" %
+              (project_name, min_previews, str(variants[v])))
     data_filename = "../query data/demo for " + project_name + ".csv"
     makedirs("../RecSys data/" + project_name, exist_ok=True)
     makedirs("./" + project_name, exist_ok=True)
 
-    print("loading raw data...")
-    query_data = pd.read_csv(data_filename)
-    query_data = query_data[["id_for_vendor", "template_name", "is_selected"]]
-    query_data.is_selected = query_data.is_selected.astype(int)
-
-    # Discard cases of multiple user-template event. Take the 'selected' label as 1 if at least one
-    # preview was selected.
-    print("cleaning data...")
-    if variant is not None:
-        if variant in ["ch", "ja"]:
-            # leave only rows in which template_name ends with the variant string
-            def is_in_var(name):
-                return name.split("-")[-1] == variant
-        else:
-            def is_in_var(name):
-                return name.split("-")[-1] not in ["ch", "ja"]
-
-        query_data["in_variant"] = query_data.template_name.apply(is_in_var)
-        query_data = query_data[query_data.in_variant]
-        query_data.drop(columns="in_variant", inplace=True)
-
-    query_data.drop_duplicates(inplace=True)
-    query_data = query_data.groupby(by=["id_for_vendor", "template_name"]).\
-        agg({"is_selected": "max"}).reset_index()
-
-    # discard users with too few events
-    query_data = query_data.groupby(by="id_for_vendor").filter(lambda x: len(x) >= min_previews)
-
-    # create serial user id and map
-    print("creating serial user id...")
-    unique_user_id = set(query_data.id_for_vendor)
-    unique_user_id = pd.DataFrame(list(unique_user_id), columns=["id_for_vendor"])
-    unique_user_id = unique_user_id.sort_values(by="id_for_vendor").reset_index(drop=True)
-    unique_user_id["user_index"] = unique_user_id.index
+    temp_dir = tempfile.mkdtemp(dir=temp_dir)
+    try:
+        print("loading raw data...")
+        partitions = partition_query_data(data_filename, temp_dir, n_partitions, chunk_size,
+                                          variants[0] if len(variants) == 1 else None)
+
+        # Discard cases of multiple user-template event. Take the 'selected' label as 1 if at
+        # least one preview was selected.
+        print("cleaning data...")
+        users = [set() for _ in datasets]
+        templates = [set() for _ in datasets]
+        for partition in partitions:
+            query_data = aggregate_partition(partition)
+            for v, variant in enumerate(variants):
+                in_variant = variant_mask(query_data.template_name, variant)
+                num_events = pd.Series(in_variant).groupby(query_data.id_for_vendor.values).\
+                    transform("sum").values
+                query_data["events %g" % v] = np.where(in_variant, num_events, 0)
+            for d, (min_previews, v) in enumerate(datasets):
+                # discard users with too few events
+                kept = query_data[dataset_rows(query_data, min_previews, v)]
+                users[d].update(kept.id_for_vendor.unique())
+                templates[d].update(kept.template_name.unique())
+            query_data.to_csv(partition, index=False)
+
+        print("creating serial user and item ids...")
+        users_maps = [index_map(users[d], "id_for_vendor", "user_index")
+                      for d in range(len(datasets))]
+        templates_maps = [index_map(templates[d], "template_name", "template_index")
+                          for d in range(len(datasets))]
+
+        print("saving files")
+        buckets = [[os.path.join(temp_dir, "dataset %g bucket %g.csv" % (d, b))
+                    for b in range(len(partitions))] for d in range(len(datasets))]
+        num_rows = np.zeros(len(datasets), dtype=int)
+        for partition in partitions:
+            query_data = pd.read_csv(partition, dtype={"id_for_vendor": str,
+                                                       "template_name": str})
+            for d, (min_previews, v) in enumerate(datasets):
+                num_rows[d] += bucket_rows(
+                    query_data[dataset_rows(query_data, min_previews, v)], users_maps[d],
+                    templates_maps[d], buckets[d])
+        for d, (min_previews, v) in enumerate(datasets):
+            write_dataset(project_name, dataset_name(min_previews, variants[v]), buckets[d],
+                          num_rows[d], users_maps[d], templates_maps[d])
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    print("process ended")
 
-    query_data = query_data.merge(unique_user_id, on="id_for_vendor")
 
-    print("creating serial item id...")
-    unique_template_name = set(query_data.template_name)
-    unique_template_name = pd.DataFrame(list(unique_template_name), columns=["template_name"])
-    unique_template_name = unique_template_name.sort_values(by="template_name").reset_index(drop=True)
-    unique_template_name["template_index"] = unique_template_name.index
-    new_df = query_data.merge(unique_template_name, on="template_name")
-    new_df = new_df.sort_values(by="user_index").reset_index(drop=True)
+def dataset_rows(query_data, min_previews, v):
+    # rows of an aggregated partition in the dataset of the v-th variant and min_previews
+    return query_data["events %g" % v].values >= max(min_previews, 1)
 
 
-    print("saving files")
+def dataset_name(min_previews, variant):
     data_name = f"min_previews %g" % min_previews
-    if variant in ["ch", "ja"]:
+    if variant in NON_US_VARIANTS:
         data_name += " - " + variant
     elif variant == "":
         data_name += " - us"
+    return data_name
+
+
+def variant_mask(template_names, variant):
+    # Rows of the variant: for the non-US variants, templates whose name ends with the variant
+    # string, otherwise templates that do not end with a non-US variant string. All rows are
+    # in the variant None.
+    if variant is None:
+        return np.ones(len(template_names), dtype=bool)
+    suffix = template_names.str.rsplit("-", n=1).str[-1]
+    if variant in NON_US_VARIANTS:
+        return (suffix == variant).values
+    return (~suffix.isin(NON_US_VARIANTS)).values
+
+
+def partition_query_data(data_filename, temp_dir, n_partitions, chunk_size, variant=None):
+    # stream the raw export into n_partitions files of (id_for_vendor, template_name,
+    # is_selected) rows, partitioned by a hash of the user. Each chunk is reduced to the max
+    # label of each user-template pair before it is written.
+    partitions = [os.path.join(temp_dir, "partition %g.csv" % p) for p in range(n_partitions)]
+    chunks = pd.read_csv(data_filename, usecols=["id_for_vendor", "template_name", "is_selected"],
+                         dtype={"id_for_vendor": str, "template_name": str},
+                         chunksize=chunk_size)
+    for chunk in chunks:
+        chunk = chunk[variant_mask(chunk.template_name, variant)]
+        chunk = chunk.assign(is_selected=chunk.is_selected.astype(np.int8))
+        chunk = chunk.groupby(by=["id_for_vendor", "template_name"], sort=False).\
+            agg({"is_selected": "max"}).reset_index()
+        partition_of_row = pd.util.hash_pandas_object(chunk.id_for_vendor, index=False).values \
+            % n_partitions
+        for p, rows in chunk.groupby(partition_of_row):
+            append_csv(rows, partitions[p])
+    return [partition for partition in partitions if os.path.exists(partition)]
+
+
+def aggregate_partition(partition):
+    query_data = pd.read_csv(partition, dtype={"id_for_vendor": str, "template_name": str})
+    return query_data.groupby(by=["id_for_vendor", "template_name"], sort=False).\
+        agg({"is_selected": "max"}).reset_index()
 
-    new_df[["user_index", "template_index", "is_selected"]].to_csv(
-        f"../RecSys data/%s/%s.csv" % (project_name, data_name), index=False)
-    unique_user_id[["user_index", "id_for_vendor"]].to_csv(
+
+def index_map(values, name, index_name):
+    # serial ids of the sorted values
+    index_map = pd.DataFrame({name: sorted(values)})
+    index_map[index_name] = index_map.index
+    return index_map
+
+
+def bucket_rows(query_data, users_map, templates_map, buckets):
+    # Append rows of a dataset to buckets of consecutive user indices, for write_dataset.
+    # Returns the number of rows.
+    usage_data = pd.DataFrame({
+        "user_index": pd.Index(users_map.id_for_vendor).get_indexer(query_data.id_for_vendor),
+        "template_index": pd.Index(templates_map.template_name).get_indexer(
+            query_data.template_name),
+        "is_selected": query_data.is_selected.values})
+    bucket_of_row = usage_data.user_index.values * len(buckets) // max(len(users_map), 1)
+    for b, rows in usage_data.groupby(bucket_of_row):
+        append_csv(rows, buckets[b])
+    return len(usage_data)
+
+
+def write_dataset(project_name, data_name, buckets, num_rows, users_map, templates_map):
+    # Write the usage data of a dataset sorted by user index, to the CSV file and to the binary
+    # copy, and its index maps. The buckets (see bucket_rows) are sorted and written one at a
+    # time.
+    data_path = "../RecSys data/%s/%s" % (project_name, data_name)
+    columns = open_binary_dataset(data_path, num_rows)
+    pd.DataFrame(columns=list(BINARY_COLUMNS.keys())).to_csv(data_path + ".csv", index=False)
+    start = 0
+    for bucket in buckets:
+        if not os.path.exists(bucket):
+            continue
+        usage_data = pd.read_csv(bucket).sort_values(by=["user_index", "template_index"])
+        usage_data.to_csv(data_path + ".csv", mode="a", header=False, index=False)
+        for column, array in columns.items():
+            array[start:start + len(usage_data)] = usage_data[column].values
+        start += len(usage_data)
+    close_binary_dataset(data_path, columns, users_map, templates_map)
+
+    users_map[["user_index", "id_for_vendor"]].to_csv(
         f"./%s/%s users_map" % (project_name, data_name), index=False)
-    unique_template_name[["template_index", "template_name"]].to_csv(
+    templates_map[["template_index", "template_name"]].to_csv(
         f"./%s/%s templates_map" % (project_name, data_name), index=False)
-    print("process ended")
+
+
+def append_csv(data, path):
+    data.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+def open_binary_dataset(directory, num_rows):
+    # Binary columnar copy of a dataset, which DataHandler loads memory-mapped instead of parsing
+    # the CSV files. The directory holds one .npy file per column of the usage data (int32
+    # indices and int8 labels), in the row order of the CSV, the per-user CSR offsets of the
+    # rows (the rows of user u are indptr[u]:indptr[u + 1]) and the string maps, indexed by user
+    # and template index. Returns the writable memory-mapped columns, to be filled with the
+    # usage data sorted by user index and then passed to close_binary_dataset.
+    makedirs(directory, exist_ok=True)
+    return {column: open_memmap(os.path.join(directory, column + ".npy"), mode="w+",
+                                dtype=dtype, shape=(int(num_rows),))
+            for column, dtype in BINARY_COLUMNS.items()}
+
+
+def close_binary_dataset(directory, columns, users_map, items_map):
+    for array in columns.values():
+        array.flush()
+    indptr = np.zeros(len(users_map) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(columns["user_index"], minlength=len(users_map)), out=indptr[1:])
+    np.save(os.path.join(directory, "indptr.npy"), indptr)
+    np.save(os.path.join(directory, "id_for_vendor.npy"),
+            users_map.sort_values(by="user_index").id_for_vendor.to_numpy(dtype=str))
+    np.save(os.path.join(directory, "template_name.npy"),
+            items_map.sort_values(by="template_index").template_name.to_numpy(dtype=str))
 
 
 if __name__ == "__main__":
@@ -78,3 +228,4 @@ if __name__ == "__main__":
     variant = "us"
 
     to_recsys_format(project_name, min_previews, variant)
+    # build_datasets(project_name, [5, 20, 50], ["", "ch", "ja"])
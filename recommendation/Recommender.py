@@ -2,6 +2,8 @@ import numpy as np
 
 from controllers.Model import ItemSimilarityModel, LowDimEmbeddingModel
 from recommendation.evaluation_module import EvaluationModule
+from recommendation.top_k import top_k
+from similarity_functions.SimFunc import CosineSimilarity
 
 
 class Recommender:
@@ -9,25 +11,34 @@ class Recommender:
         self.data_handler = data_handler
         self.evaluation_module = EvaluationModule(data_handler)
 
-    def calc_hit_rate(self, n):
-        LOO_data, left_out = self.data_handler.prepare_LOO_dataset()
+    def calc_hit_rate(self, n, dataset="LOO"):
+        # hit rate on a held-out dataset of the data handler. The default LOO split is prepared
+        # on demand; other splits (see DataHandler.prepare_fold_dataset) must be prepared first.
+        if dataset == "LOO":
+            self.data_handler.prepare_LOO_dataset()
+        left_out = self.data_handler.getLeftOut(dataset)
 
-        users_list = self.data_handler.getUserIds(dataset="LOO")
-        print("number of users in LOO dataset: %g" % len(users_list))
+        users_list = self.data_handler.getUserIds(dataset=dataset)
+        print("number of users in %s dataset: %g" % (dataset, len(users_list)))
 
-        recommendations = self.recommend_for_users(users_list, n, dataset="LOO")
+        recommendations = self.recommend_for_users(users_list, n, dataset=dataset)
         hit_rate = self.evaluation_module.calc_hit_rate(recommendations, left_out)
         return hit_rate
 
+    def calc_metrics(self, n, dataset="LOO"):
+        # hit rate, hit position quantiles, MRR, NDCG@n, coverage and novelty of the
+        # recommendations for the users of a held-out dataset (see calc_hit_rate)
+        if dataset == "LOO":
+            self.data_handler.prepare_LOO_dataset()
+        left_out = self.data_handler.getLeftOut(dataset)
+        users_list = self.data_handler.getUserIds(dataset=dataset)
+        recommendations = self.recommend_for_users(users_list, n, dataset=dataset)
+        return self.evaluation_module.calc_metrics(recommendations, left_out)
+
     def calc_match_index(self, n):
-        indices = []
         n_items = self.data_handler.getNumItems()
-        nearest_neighbors, _ = self.recommend_for_items(list(range(n_items)), n)
-
-        for item in range(n_items):
-            nearest_to_item = nearest_neighbors[item]
-            indices.append(self.evaluation_module.neighbor_category_match(item,
-                                                                          nearest_to_item))
+        nearest_neighbors, _ = self.recommend_for_items(np.arange(n_items), n)
+        indices = self.evaluation_module.calc_match_indices(nearest_neighbors)
         return np.mean(indices)
 
     def calc_novelty_score(self, n):
@@ -50,35 +61,36 @@ class Recommender:
 
 class ItemSimilarityRecommender(Recommender):
 
-    def __init__(self, dh, algo, k, simfunc, scores_chart):
+    def __init__(self, dh, algo, k, simfunc, scores_chart, store=None):
         super().__init__(dh)
-        self.model = ItemSimilarityModel(algo, k, simfunc)
+        self.model = ItemSimilarityModel(algo, k, simfunc, store, dtype=dh.dtypes["float"])
         self.scores_chart = scores_chart
 
     def recommend_for_users(self, users, n, dataset="all"):
         data = self.data_handler.getData(dataset)
-        similarities = self.model.GetSimilarities(data)
-        recommendations = self.evaluation_module.get_recommendations_for_users(
+        fingerprint = self.data_handler.getFingerprint(dataset)
+        similarities = self.model.GetSimilarities(data, fingerprint)
+        recommendations = self.evaluation_module.get_batch_recommendations_for_users(
             users, similarities, n, self.scores_chart, dataset=dataset)
         return recommendations
 
     def recommend_for_items(self, items, n):
-
+        # slices of the model's item-kNN table
         data = self.data_handler.getData("all")
-        similarities = self.model.GetSimilarities(data)
-        nearest_neighbors, distances = \
-            self.evaluation_module.get_item_neighbors(items, similarities, n)
-        return nearest_neighbors, distances
+        nearest_neighbors, distances = self.model.GetItemNeighbors(
+            data, n, self.data_handler.getFingerprint("all"))
+        return nearest_neighbors[items], distances[items]
 
 
 class UserBasedRecommender(Recommender):
 
     def __init__(self, dh, algo, k, simfunc, scores_chart, n_neighbors=10, d_neighbors=5,
-                 d_user=5):
+                 d_user=5, store=None):
         super().__init__(dh)
-        self.model = LowDimEmbeddingModel(algo, k, simfunc)
+        self.model = LowDimEmbeddingModel(algo, k, simfunc, store, dtype=dh.dtypes["float"])
         self.simfunc = simfunc(k)
         self.scores_chart = scores_chart
+        self.item_depth = max(d_neighbors, d_user)
         self.recommendation_function = \
             self.evaluation_module.establish_user_based_recommendation_function(n_neighbors,
                                                                                 d_neighbors,
@@ -87,15 +99,32 @@ class UserBasedRecommender(Recommender):
 
     def recommend_for_users(self, users, n, dataset="all"):
         data = self.data_handler.getData(dataset)
-        user_embeddings = self.model.GetUserEmbeddings(data)
-        item_similarity = self.model.GetItemSimilarities(data)
-        recommendations = self.recommendation_function(users, user_embeddings, item_similarity, n,
+        fingerprint = self.data_handler.getFingerprint(dataset)
+        user_embeddings = self.model.GetUserEmbeddings(data, fingerprint)
+        item_neighbors = self.model.GetItemNeighbors(data, self.item_depth, fingerprint)
+        recommendations = self.recommendation_function(users, user_embeddings, item_neighbors, n,
                                                        self.scores_chart, dataset=dataset)
         return recommendations
 
     def recommend_for_items(self, items, n):
-        recommendations, votes = self.evaluation_module.get_user_votes(items, n, dataset="all")
-        return recommendations, votes
+        # slices of the model's item-kNN table, as for item similarity
+        data = self.data_handler.getData("all")
+        nearest_neighbors, distances = self.model.GetItemNeighbors(
+            data, n, self.data_handler.getFingerprint("all"))
+        return nearest_neighbors[items], distances[items]
+
+    def calc_neighbor_recall(self, n_neighbors, users=None):
+        # fraction of the exact n_neighbors nearest users that are found by the recommender's
+        # similarity function (relevant for approximate nearest neighbor search)
+        data = self.data_handler.getData("all")
+        fingerprint = self.data_handler.getFingerprint("all")
+        user_embeddings = self.model.GetUserEmbeddings(data, fingerprint)
+        users = self.data_handler.getUserIds() if users is None else users
+        found, _ = self.simfunc.nearest_neighbors(user_embeddings, n_neighbors, subject_ids=users)
+        exact, _ = CosineSimilarity(self.model.k).nearest_neighbors(user_embeddings, n_neighbors,
+                                                                   subject_ids=users)
+        hits = (found[:, :, None] == exact[:, None, :]).any(axis=2)
+        return hits.mean()
 
 
 class RandomRecommender(Recommender):
@@ -118,29 +147,35 @@ class PopularityRecommender(Recommender):
 
     def __init__(self, dh):
         super().__init__(dh)
-        self.popularity = get_popularity_as_similarity_matrix(self.data_handler.data)
+        self.popularity = self.data_handler.getPopularityRanks()
+        # items ordered from the most popular to the least popular
+        self.ranking = np.argsort(-self.popularity, kind="stable")
 
     def recommend_for_items(self, items, n):
-        recommendations, ranks = \
-            self.evaluation_module.get_item_neighbors(items, self.popularity, n)
-        return recommendations, ranks
+        # the nearest neighbors of every item are the most popular items other than itself
+        candidates = self.ranking[:n + 1]
+        is_self = candidates[None, :] == np.asarray(items)[:, None]
+        recommendations, _ = top_k(np.broadcast_to(-np.arange(len(candidates)), is_self.shape),
+                                   n, exclude=is_self)
+        recommendations = candidates[recommendations]
+        return recommendations, self.popularity[recommendations]
 
     def recommend_for_users(self, users, n, dataset="all"):
-        recommendations = self.evaluation_module.get_recommendations_for_users(
-            users, self.popularity, n, scores_chart={"0": 0, "1": 1}, dataset=dataset)
-        return recommendations
-
-
-def get_popularity_as_similarity_matrix(data):
-    # get a matrix in which all rows are identical and represent popularity: in the position of
-    # the least popular we have 0, the next least popular is 1 and so on, the most popular is N
-    # (N being the number of items)
-    unique, counts = np.unique(data.template_index.values, return_counts=True)
-    temp = np.argsort(counts)
-    popularity_ranks = np.empty_like(temp)
-    popularity_ranks[temp] = np.arange(len(temp))
-
-    n_items = len(popularity_ranks)
-    popularity_as_similarities = np.repeat([popularity_ranks], n_items, axis=0)
+        # recommend the most popular items that were not used by the user. Only the top n +
+        # (number of used items) items of the ranking can be recommended to a user.
+        indptr, used_items, _ = self.data_handler.getUsersActivity(users, dataset=dataset)
+        num_used = np.diff(indptr)
+        candidates = self.ranking[:n + (num_used.max() if len(users) > 0 else 0)]
+
+        ranking_position = np.empty_like(self.ranking)
+        ranking_position[self.ranking] = np.arange(len(self.ranking))
+        used_positions = ranking_position[used_items]
+        is_candidate = used_positions < len(candidates)
+        is_used = np.zeros((len(users), len(candidates)), dtype=bool)
+        is_used[np.repeat(np.arange(len(users)), num_used)[is_candidate],
+                used_positions[is_candidate]] = True
+
+        recommendations, _ = top_k(np.broadcast_to(-np.arange(len(candidates)), is_used.shape),
+                                   n, exclude=is_used)
+        return candidates[recommendations]
 
-    return popularity_as_similarities
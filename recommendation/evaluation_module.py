@@ -1,32 +1,38 @@
+import hashlib
+
 import numpy as np
+from scipy.sparse import csr_matrix, identity
+
+from recommendation.metrics import recommendation_metrics
+from recommendation.top_k import top_k
 
 
 class EvaluationModule:
 
     def __init__(self, datahandler):
         self.datahandler = datahandler
+        self.match_indices_cache = {}
 
     def calc_hit_rate(self, recommendations, left_out):
         print("calculating hit rate\n")
-        hits = 0
-        for i, item in enumerate(left_out):
-            hits += item in recommendations[i]
-
-        return hits / len(left_out)
+        return recommendation_metrics(recommendations, left_out)["hit_rate"]
 
     def calc_novelty_score(self, recommendations):
-
-        # get popularity rank
-        data = self.datahandler.data
-        unique, counts = np.unique(data.template_index.values, return_counts=True)
-        temp = np.argsort(counts)
-        ranks = np.empty_like(temp)
-        ranks[temp] = np.arange(len(temp))
-        ranks = len(ranks) - ranks  # np.where(ranks==1) is the most popular,
-        # np.where(ranks==ranks.max()) is the least popular
-
-        novelty_score = ranks[recommendations].sum()/np.prod(recommendations.shape)
-        return novelty_score
+        return recommendation_metrics(recommendations,
+                                      novelty_ranks=self.get_novelty_ranks())["novelty"]
+
+    def calc_metrics(self, recommendations, left_out):
+        # hit rate, hit position quantiles, MRR, NDCG, coverage and novelty of recommendations
+        # (see recommendation_metrics)
+        return recommendation_metrics(recommendations, left_out,
+                                      novelty_ranks=self.get_novelty_ranks(),
+                                      num_items=self.datahandler.getNumItems())
+
+    def get_novelty_ranks(self):
+        # np.where(ranks==1) is the most popular, np.where(ranks==ranks.max()) is the least
+        # popular
+        popularity_ranks = self.datahandler.getPopularityRanks()
+        return len(popularity_ranks) - popularity_ranks
 
     def establish_user_based_recommendation_function(self, n_neighbors, depth_neighbors,
                                                      depth_user, similarity_function):
@@ -34,50 +40,50 @@ class EvaluationModule:
         # with depth_neighbors=0 and depth_user=0 this is standard user based recommendation of
         # items (without neighboring items)
 
-        def recommendation_function(users, user_embeddings, item_similarity, n, scores_chart,
-                                    dataset="all"):
+        def recommendation_function(users, user_embeddings, item_neighbors, n, scores_chart,
+                                    dataset="all", batch_size=1024):
             # for each user, take nearest n_neighbors. For each item used by the neighbors,
             # take depth_neighbors nearest items. Weigh items by distance in the item domain and
             # users domain. For each item used by the user, take depth_user nearest item and
             # weigh them by distance in the item domain. Discard used items and recommend top n.
             # The output should be a numpy array with shape (len(users), n)
-
-            nearest_users, distances = self.find_nearest_users(users, user_embeddings, n_neighbors,
-                                                               similarity_function)
+            # Users are processed in batches of batch_size. item_neighbors is an item-kNN table
+            # (see ItemSimilarityModel.GetItemNeighbors): the nearest items of every item and
+            # their similarities, for at least max(depth_neighbors, depth_user) nearest items.
 
             # The variant that calls self.weight_item_based_recommendations is correct, however it
             # implements a weighing that is based on the *recommendations* to the neighbors (
             # weights the top-n items for each user, where n=depth_neighbors). Therefore,
             # if depth_neighbors=0, it will not implement a standard user-based collaborative
             # filtering recommendation (it will give one arbitrary item from each neighbor).
-            # This method will be replaced by a more correct one, however
-            # self.weight_item_based_recommendations will still be available for future reference.
-            # This method is currently not computationally efficient, as it repeatedly computes
-            # recommendations for the neighbors of each subject user. It will not undergo the
-            # required improvement of computing all recommendations in advance and reading them
-            # from memory.
-
-            # weighted_items = self.weight_item_based_recommendations(
-            #   nearest_users, distances, item_similarity, scores_chart, depth_neighbors, dataset)
-
-            weighted_items = self.weight_items_by_users(
-                nearest_users, distances, item_similarity, scores_chart, depth_neighbors, dataset)
-
-            rearranged_users = np.reshape(np.array(users), (len(users), 1))
-            dummy_distances = np.ones(len(users))
-
-            # user_weighted_items = self.weight_item_based_recommendations(
-            #     rearranged_users, dummy_distances, item_similarity, scores_chart, depth_user,
-            #     dataset)
-
-            user_weighted_items = self.weight_items_by_users(
-                rearranged_users, dummy_distances, item_similarity, scores_chart, depth_user,
-                dataset)
-
-            weighted_items += user_weighted_items
-
-            recommendations = self.get_recommendations_from_weights(users, weighted_items, n,
-                                                                    dataset)
+            # self.weight_item_based_recommendations is still available for future reference.
+            # It is not computationally efficient, as it repeatedly computes recommendations for
+            # the neighbors of each subject user.
+
+            users = np.asarray(users, dtype=int)
+            item_knn = {depth: self.get_item_knn_matrix(item_neighbors, depth)
+                        for depth in {depth_neighbors, depth_user}}
+            # with n larger than the number of items, all items are recommended
+            recommendations = np.zeros((len(users), min(n, item_knn[depth_user].shape[0])),
+                                       dtype=int)
+
+            for start in range(0, len(users), batch_size):
+                batch_users = users[start:start + batch_size]
+                nearest_users, distances = self.find_nearest_users(
+                    batch_users, user_embeddings, n_neighbors, similarity_function)
+
+                weighted_items = self.weight_items_by_users(
+                    nearest_users, distances, None, scores_chart, depth_neighbors, dataset,
+                    item_knn=item_knn[depth_neighbors])
+
+                rearranged_users = np.reshape(batch_users, (len(batch_users), 1))
+                dummy_distances = np.ones((len(batch_users), 1), dtype=distances.dtype)
+                weighted_items += self.weight_items_by_users(
+                    rearranged_users, dummy_distances, None, scores_chart, depth_user, dataset,
+                    item_knn=item_knn[depth_user])
+
+                recommendations[start:start + batch_size] = \
+                    self.get_recommendations_from_weights(batch_users, weighted_items, n, dataset)
 
             return recommendations
 
@@ -85,38 +91,20 @@ class EvaluationModule:
 
     def find_nearest_users(self, users, user_embeddings, n_neighbors, similarity_function):
 
-        user_representations = user_embeddings[:, users]
-        similarity_rows = similarity_function(user_embeddings,
-                                              subject_vectors=user_representations)
-        most_similar = np.argsort(similarity_rows)[:, -n_neighbors - 1:]
-
-        nearest_neighbors = np.empty((len(users), n_neighbors), dtype=np.int)
-        for i, user in enumerate(users):
-            if user in most_similar[i]:
-                nearest_neighbors[i] = most_similar[i][most_similar[i] != user]
-            else:
-                nearest_neighbors[i] = most_similar[i, -n_neighbors:]
-        distances = [similarity_rows[i, nearest_neighbors[i]] for i in range(len(users))]
-        distances = np.fliplr(distances)
-
-        return np.fliplr(nearest_neighbors), distances
+        # similarities are computed for blocks of users, keeping only the nearest neighbors of
+        # each user rather than the full (users x users) similarity matrix. A user is always
+        # nearest to itself and is therefore excluded.
+        nearest_neighbors, distances = similarity_function.nearest_neighbors(
+            user_embeddings, n_neighbors, subject_ids=users)
+        return nearest_neighbors, distances
 
     def get_item_neighbors(self, item_ids, similarities, n):
 
         similarity_rows = similarities[item_ids, :]
-        most_similar = np.argsort(similarity_rows)[:, -n - 1:]  # taking n+1 items since item
-        #  is always nearest itself
-        nearest_neighbors = np.empty((len(item_ids), n), dtype=np.int)
-        for i, item_id in enumerate(item_ids):
-            if item_id in most_similar[i]:
-                nearest_neighbors[i] = most_similar[i][most_similar[i] != item_id]
-            else:
-                nearest_neighbors[i] = most_similar[i, -n:]
-
-        distances = [similarity_rows[i, nearest_neighbors[i]] for i in range(len(item_ids))]
-        distances = np.fliplr(distances)
-
-        return np.fliplr(nearest_neighbors), distances
+        # an item is always nearest to itself
+        nearest_neighbors, distances = top_k(similarity_rows, n,
+                                             exclude=(np.arange(len(item_ids)), item_ids))
+        return nearest_neighbors, distances
 
     def get_recommendations_by_items(self, item_ids, item_scores, similarities, n,
                                      return_weights=False, discard_input_items=True):
@@ -128,22 +116,14 @@ class EvaluationModule:
         similarity_rows = similarities[item_ids, :]
         scored_rows = similarity_rows * item_scores[:, None]
         weighted_sums = scored_rows.sum(axis=0)
-        most_similar = np.argsort(weighted_sums)[-n - len(item_ids):]
-        if discard_input_items:
-            for item in item_ids:
-                if item in most_similar:
-                    most_similar = most_similar[most_similar != item]
-        recommended = most_similar[-n:]
-
-        # user may have used more than n_items - n_for_recommendation items. In this case we add
-        # previously used items at the end of the recommended items list
-        if len(recommended) < n:
-            num_missing = n - len(recommended)
-            picked_from_used = np.random.choice(item_ids, num_missing)
-            recommended = np.insert(recommended, 0, picked_from_used)
+
+        # user may have used more than n_items - n_for_recommendation items. In this case
+        # previously used items are placed at the end of the recommended items list
+        recommended, _ = top_k(weighted_sums, n,
+                               exclude=item_ids if discard_input_items else None)
         if return_weights:
-            return np.flip(recommended), np.flip(weighted_sums[recommended] / len(item_ids))
-        return np.flip(recommended)
+            return recommended, weighted_sums[recommended] / len(item_ids)
+        return recommended
 
     def get_recommendations_for_users(self, users_ids, similarities, n, scores_chart,
                                       dataset="all", return_weights=False,
@@ -153,16 +133,14 @@ class EvaluationModule:
         # to the scores chart.
         # Then get recommendations for the set of items with their labels and store them in an
         # array to return
-        recommendations = np.zeros((len(users_ids), n), dtype=np.int)
+        recommendations = np.zeros((len(users_ids), n), dtype=int)
         weights = np.zeros((len(users_ids), n))
 
         # print("setting recommendations for each user")
         for i, user in enumerate(users_ids):
             user_activity = self.datahandler.getUserActivity(user, dataset=dataset)
             items = user_activity[:, 0]
-            labels = user_activity[:, 1]
-            for label, score in scores_chart.items():
-                labels[np.where(labels == int(label))] = score
+            labels = labels_to_scores(user_activity[:, 1], scores_chart)
             temp_recommendations = self.get_recommendations_by_items(items, labels,
                                                                      similarities, n,
                                                                      return_weights,
@@ -177,46 +155,86 @@ class EvaluationModule:
         else:
             return recommendations
 
-    def get_recommendations_from_weights(self, users, weighted_items, n, dataset="all"):
+    def get_batch_recommendations_for_users(self, users_ids, similarities, n, scores_chart,
+                                            dataset="all", return_weights=False,
+                                            discard_self_usage=True, batch_size=1024):
+        # Vectorized equivalent of get_recommendations_for_users. For each batch of users, build
+        # the sparse (users x items) matrix of scores, i.e. the labels transformed according to
+        # the scores chart, and multiply it by the similarity matrix. Each row of the product holds
+        # the weighted sums of similarities to the items used by the user. The top n unused items
+        # of each row are then selected for the whole batch at once.
+        users_ids = np.asarray(users_ids, dtype=int)
+        num_items = similarities.shape[1]
+        # with n larger than the number of items, all items are recommended
+        recommendations = np.zeros((len(users_ids), min(n, num_items)), dtype=int)
+        weights = np.zeros((len(users_ids), min(n, num_items)))
+
+        for start in range(0, len(users_ids), batch_size):
+            batch_users = users_ids[start:start + batch_size]
+            indptr, items, labels = self.datahandler.getUsersActivity(batch_users, dataset)
+            scores = labels_to_scores(labels, scores_chart, dtype=similarities.dtype)
+            usage = csr_matrix((scores, items, indptr), shape=(len(batch_users), num_items))
+            weighted_sums = np.asarray(usage @ similarities)
+            num_used = np.diff(indptr)
+
+            # A user that used more than num_items - n items gets previously used items at the
+            # end of the list
+            used = (np.repeat(np.arange(len(batch_users)), num_used), items)
+            top, _ = top_k(weighted_sums, n, exclude=used if discard_self_usage else None)
+
+            recommendations[start:start + batch_size] = top
+            if return_weights:
+                weights[start:start + batch_size] = \
+                    np.take_along_axis(weighted_sums, top, axis=1) / \
+                    np.maximum(num_used, 1)[:, None]
+
+        if return_weights:
+            return recommendations, weights
+        else:
+            return recommendations
 
-        # find top-n weighted items and discard already used items
-        recommendations = np.zeros((len(users), n), dtype=np.int)
-        ordered_items = np.argsort(weighted_items)
-
-        for i, user in enumerate(users):
-            used_items = self.datahandler.getUserActivity(user, dataset=dataset)[:, 0]
-            top_items = ordered_items[i, -n - len(used_items):]
-            for item in used_items:
-                if item in top_items:
-                    top_items = top_items[top_items != item]
-            recommended = top_items[-n:]
-            # Add random unused items at the end of the recommended items list if not
-            # enough are recommended upon
-            if len(recommended) < n:
-                num_missing = n - len(recommended)
-                picked_from_used = np.random.choice(used_items, num_missing)
-                recommended = np.insert(recommended, 0, picked_from_used)
-
-            recommendations[i] = np.flip(recommended)
+    def get_recommendations_from_weights(self, users, weighted_items, n, dataset="all"):
 
+        # find top-n weighted items and discard already used items. Previously used items are
+        # placed at the end of the recommended items list if not enough are recommended upon
+        indptr, used_items, _ = self.datahandler.getUsersActivity(users, dataset=dataset)
+        used = (np.repeat(np.arange(len(users)), np.diff(indptr)), used_items)
+        recommendations, _ = top_k(weighted_items, n, exclude=used)
         return recommendations
 
     def neighbor_category_match(self, subject_item, neighboring_items):
-
-        match_index = 0
-        item_categories = set(self.datahandler.getItemCategories(subject_item))
-        if item_categories == set():
-            return 0
-
-        for neighbor in neighboring_items:
-            neighbor_categories = set(self.datahandler.getItemCategories(neighbor))
-            if neighbor_categories == set():
-                category_match = 0
-            else:
-                category_match = len(item_categories.intersection(neighbor_categories)) / \
-                    np.sqrt(len(item_categories) * len(neighbor_categories))
-            match_index += category_match
-        return match_index / len(neighboring_items)
+        return self.category_match([subject_item], [neighboring_items])[0]
+
+    def category_match(self, subject_items, neighboring_items):
+        # For each subject item (with a row of neighboring_items), the mean category match of its
+        # neighbors, where the match of items with category sets A and B is
+        # |A & B| / sqrt(|A||B|), or 0 if either set is empty. The intersections of all (item,
+        # neighbor) pairs are computed at once as row-dots of the sparse (items x categories)
+        # matrix of the data handler.
+        subject_items = np.asarray(subject_items)
+        neighboring_items = np.asarray(neighboring_items)
+        categories = self.datahandler.getCategoryMatrix()
+        num_categories = np.asarray(categories.sum(axis=1)).ravel()
+
+        subjects = np.repeat(subject_items, neighboring_items.shape[1])
+        neighbors = np.ravel(neighboring_items)
+        intersections = np.asarray(
+            categories[subjects].multiply(categories[neighbors]).sum(axis=1)).ravel()
+        normalization = np.sqrt(num_categories[subjects] * num_categories[neighbors])
+        matches = np.divide(intersections, normalization, out=np.zeros(len(subjects)),
+                            where=normalization > 0)
+        return matches.reshape(neighboring_items.shape).mean(axis=1)
+
+    def calc_match_indices(self, neighbor_table):
+        # category_match of every item with its row of neighbor_table. The results are cached by
+        # the content of the table, so that repeated evaluations of the same neighbors are free.
+        neighbor_table = np.asarray(neighbor_table)
+        key = hashlib.sha1(np.ascontiguousarray(neighbor_table).tobytes()).hexdigest() + \
+            str(neighbor_table.shape)
+        if key not in self.match_indices_cache:
+            self.match_indices_cache[key] = self.category_match(np.arange(len(neighbor_table)),
+                                                                neighbor_table)
+        return self.match_indices_cache[key]
 
     def weight_item_based_recommendations(self, nearest_users, distances, item_similarity, scores_chart,
                                           depth, dataset="all"):
@@ -237,23 +255,54 @@ class EvaluationModule:
         return weighted_items
 
     def weight_items_by_users(self, neighboring_users, distances, item_similarity, scores_chart,
-                              depth, dataset="all"):
-
-        num_items = self.datahandler.getNumItems(dataset)
-        weighted_items = np.zeros((neighboring_users.shape[0], num_items))
-        for i, neighbors_set in enumerate(neighboring_users):
-            for neighbor in neighbors_set:
-                used_items = self.datahandler.getUserActivity(neighbor, dataset=dataset)
-                neighboring_items, weights = self.get_item_neighbors(used_items, item_similarity,
-                                                                     depth)
-                # weight neighboring items of each neighboring user by the distance of the
-                # neighbor user from the subject user
-
-
-                ###  this is wrong since all neighboring items are from one user!!!
-                ### maybe should normalize in some way
-                weights = (weights.T * distances[i]).T
-                # sum weights from all neighbors
-                for j in range(len(neighbors_set)):
-                    weighted_items[i, nearest_items[j]] += weights[j]
-        return weighted_items
\ No newline at end of file
+                              depth, dataset="all", item_knn=None):
+        # For each subject user (a row of neighboring_users), score items by the usage of their
+        # neighboring users: every item used by a neighbor contributes its score (its label
+        # transformed by the scores chart), weighted by the neighbor's distance from the subject
+        # user, to itself and to its depth nearest items, weighted there also by their
+        # similarity to it. With depth=0 this is standard user based weighting of used items.
+        # All subject users are handled at once as the sparse product
+        # (subject users x neighbors) @ (neighbors x items usage) @ (items x items kNN).
+        # item_knn may hold a precomputed get_item_knn_matrix of the item neighbors, in which
+        # case item_similarity is not used.
+        if item_knn is None:
+            num_items = item_similarity.shape[0]
+            item_knn = self.get_item_knn_matrix(
+                self.get_item_neighbors(np.arange(num_items), item_similarity, depth), depth)
+        num_subjects, num_neighbors = neighboring_users.shape
+
+        neighbors, neighbor_columns = np.unique(neighboring_users, return_inverse=True)
+        subjects_to_neighbors = csr_matrix(
+            (np.ravel(distances), (np.repeat(np.arange(num_subjects), num_neighbors),
+                                   np.ravel(neighbor_columns))),
+            shape=(num_subjects, len(neighbors)))
+
+        indptr, items, labels = self.datahandler.getUsersActivity(neighbors, dataset=dataset)
+        usage = csr_matrix((labels_to_scores(labels, scores_chart, dtype=item_knn.dtype), items,
+                            indptr), shape=(len(neighbors), item_knn.shape[0]))
+
+        return (subjects_to_neighbors @ usage @ item_knn).toarray()
+
+    def get_item_knn_matrix(self, item_neighbors, depth):
+        # sparse (items x items) matrix in which row j holds 1 for item j itself and the
+        # similarities of its depth nearest items. item_neighbors holds the nearest items of
+        # every item and their similarities, for at least depth nearest items.
+        nearest_items, similarities = item_neighbors
+        num_items = nearest_items.shape[0]
+        item_knn = identity(num_items, dtype=similarities.dtype, format="csr")
+        if depth > 0:
+            nearest_items = nearest_items[:, :depth]
+            similarities = similarities[:, :depth]
+            rows = np.repeat(np.arange(num_items), nearest_items.shape[1])
+            item_knn = item_knn + csr_matrix(
+                (np.ravel(similarities), (rows, np.ravel(nearest_items))),
+                shape=(num_items, num_items))
+        return item_knn
+
+
+def labels_to_scores(labels, scores_chart, dtype=float):
+    # transform preview labels to scores according to the scores chart, e.g. {"0": -1, "1": 1}
+    scores = labels.astype(dtype)
+    for label, score in scores_chart.items():
+        scores[labels == int(label)] = score
+    return scores
@@ -0,0 +1,44 @@
+import numpy as np
+
+# quantiles of the positions of hits in the recommendation lists
+HIT_POSITION_QUANTILES = {"min": 0, "Q1": 0.25, "median": 0.5, "Q3": 0.75, "max": 1}
+
+
+def hit_positions(recommendations, left_out):
+    # position (1 for the first recommendation) of each user's left-out item in the user's row of
+    # recommendations, or 0 if it was not recommended
+    hits = np.asarray(recommendations) == np.asarray(left_out)[:, None]
+    return np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, 0)
+
+
+def recommendation_metrics(recommendations, left_out=None, novelty_ranks=None, num_items=None):
+    # Metrics of a (users x n) array of recommendations, computed in one vectorized pass:
+    # - with the left-out item of each user: the hit rate, the quantiles of the positions of the
+    #   hits (see HIT_POSITION_QUANTILES), the mean reciprocal rank and NDCG@n, which for a
+    #   single left-out item is the mean of 1 / log2(position + 1) over users
+    # - with the number of items: the coverage, the fraction of items recommended to any user
+    # - with the novelty rank of each item (1 for the most popular): the novelty, the mean rank
+    #   of the recommended items
+    recommendations = np.asarray(recommendations)
+    metrics = {}
+    if left_out is not None:
+        positions = hit_positions(recommendations, left_out)
+        is_hit = positions > 0
+        reciprocal_ranks = np.zeros(len(positions))
+        reciprocal_ranks[is_hit] = 1 / positions[is_hit]
+        gains = np.zeros(len(positions))
+        gains[is_hit] = 1 / np.log2(positions[is_hit] + 1)
+
+        metrics["hit_rate"] = is_hit.mean()
+        metrics["hit_position"] = dict(zip(
+            HIT_POSITION_QUANTILES.keys(),
+            np.quantile(positions[is_hit], list(HIT_POSITION_QUANTILES.values()))
+            if is_hit.any() else np.full(len(HIT_POSITION_QUANTILES), np.nan)))
+        metrics["mrr"] = reciprocal_ranks.mean()
+        metrics["ndcg"] = gains.mean()
+    if num_items is not None:
+        metrics["coverage"] = np.count_nonzero(
+            np.bincount(np.ravel(recommendations), minlength=num_items)) / num_items
+    if novelty_ranks is not None:
+        metrics["novelty"] = novelty_ranks[recommendations].mean()
+    return metrics
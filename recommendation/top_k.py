@@ -0,0 +1,51 @@
+import numpy as np
+
+
+def top_k(scores, k, exclude=None):
+    # Select the k highest scoring columns of each row of scores, without sorting whole rows.
+    # The k-th largest score of each row is found with np.partition, then all columns scoring
+    # above it are taken, along with as many columns scoring exactly the k-th score as needed,
+    # lowest column index first. The selected columns are returned ordered by descending score,
+    # ties broken by ascending column index, so results do not depend on the sorting algorithm.
+    #
+    # exclude may be a boolean mask with the shape of scores, or index arrays: a tuple of (rows,
+    # columns) for a batch of rows, or the excluded columns for a single row. Excluded entries
+    # are ranked below all other entries and get a score of -inf, so they are only returned when
+    # a row has fewer than k allowed columns.
+    #
+    # scores may be 1-d (a single row) or 2-d (a batch of rows). Returns the selected column
+    # indices and their scores, each with the shape of scores with the last axis cut down to k.
+    # Floating point scores keep their precision (e.g. float32), other scores are cast to float.
+    scores = np.asarray(scores)
+    if scores.dtype.kind != "f":
+        scores = scores.astype(float)
+    single_row = scores.ndim == 1
+    scores = np.atleast_2d(scores)
+    if exclude is not None:
+        scores = scores.copy()
+        if single_row:
+            scores[0, exclude] = -np.inf
+        else:
+            scores[exclude] = -np.inf
+
+    n_rows, n_columns = scores.shape
+    k = min(k, n_columns)
+    if k == 0 or n_rows == 0:
+        indices = np.empty((n_rows, k), dtype=int)
+        values = np.empty((n_rows, k), dtype=scores.dtype)
+    else:
+        kth_score = -np.partition(-scores, k - 1, axis=1)[:, k - 1:k]
+        above = scores > kth_score
+        at = scores == kth_score
+        num_missing = k - above.sum(axis=1, keepdims=True)
+        selected = above | (at & (np.cumsum(at, axis=1) <= num_missing))
+
+        indices = np.nonzero(selected)[1].reshape(n_rows, k)
+        values = np.take_along_axis(scores, indices, axis=1)
+        order = np.argsort(-values, axis=1, kind="stable")
+        indices = np.take_along_axis(indices, order, axis=1)
+        values = np.take_along_axis(values, order, axis=1)
+
+    if single_row:
+        return indices[0], values[0]
+    return indices, values
@@ -1,6 +1,9 @@
 
+import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 
+from recommendation.top_k import top_k
+
 
 class SimFunc:
 
@@ -9,10 +12,48 @@ class SimFunc:
         self.func = None
         self.k = k
 
+    def get_params(self):
+        # parameters that, along with the name, determine the similarities and neighbors found
+        return {}
+
     def __call__(self, embeddings):
         raise NotImplementedError("call function for embeddings data must be implemented by "
                                   "inherited SimFunc object")
 
+    def nearest_neighbors(self, embeddings, n_neighbors, subject_ids=None, subject_vectors=None,
+                          block_size=1024):
+        # Chunked alternative to computing the full similarity matrix: similarities of the
+        # subjects to all embedded entities are computed for blocks of block_size subjects, and
+        # only the top n_neighbors of each block are kept. Memory then scales as
+        # O(block_size * N + n_subjects * n_neighbors) instead of O(n_subjects * N).
+        # Subjects are given either by their ids (columns of embeddings), in which case a
+        # subject is not its own neighbor, or by their vectors. Returns the neighbors' ids and
+        # similarities, each of shape (n_subjects, n_neighbors).
+        embeddings = embeddings.T if embeddings.shape[0] == self.k else embeddings
+        if subject_vectors is None:
+            subject_ids = np.arange(len(embeddings)) if subject_ids is None else \
+                np.asarray(subject_ids)
+            subject_vectors = embeddings[subject_ids]
+        else:
+            subject_vectors = subject_vectors.T if subject_vectors.shape[0] == self.k else \
+                subject_vectors
+
+        n_subjects = len(subject_vectors)
+        # a subject given by its id has one fewer candidate neighbor, itself being excluded
+        n_neighbors = min(n_neighbors, len(embeddings) - (subject_ids is not None))
+        neighbors = np.empty((n_subjects, n_neighbors), dtype=int)
+        similarities = np.empty((n_subjects, n_neighbors),
+                                dtype=np.result_type(embeddings.dtype, np.float32))
+        for start in range(0, n_subjects, block_size):
+            block = slice(start, start + block_size)
+            block_similarities = self(embeddings, subject_vectors=subject_vectors[block])
+            exclude = None
+            if subject_ids is not None:
+                exclude = (np.arange(len(block_similarities)), subject_ids[block])
+            neighbors[block], similarities[block] = top_k(block_similarities, n_neighbors,
+                                                          exclude=exclude)
+        return neighbors, similarities
+
 
 class CosineSimilarity(SimFunc):
 
@@ -33,4 +74,108 @@ class CosineSimilarity(SimFunc):
         return self.func(embeddings)
 
 
-available_metrics = [CosineSimilarity]
+class IVFCosineSimilarity(CosineSimilarity):
+    # Cosine similarity with approximate nearest neighbor search. The full similarity matrix
+    # (__call__) is computed exactly, but nearest_neighbors queries an inverted-file (IVF) index:
+    # the normalized embeddings are partitioned into n_lists clusters by spherical k-means, and
+    # each query is scored only against the members of the n_probe clusters whose centroids are
+    # most similar to it. Recall is tuned by n_probe (n_probe = n_lists is an exact search).
+    # Queries that find fewer than n_neighbors candidates in their probed clusters fall back to
+    # an exact search.
+    #
+    # Recommenders construct similarity functions with k only; other parameters are set with
+    # e.g. functools.partial(IVFCosineSimilarity, n_probe=4).
+
+    def __init__(self, k, n_lists=None, n_probe=8, n_iter=10, seed=0):
+        super().__init__(k)
+        self.name = "IVF cosine similarity"
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.index = None
+        self.index_of = None
+
+    def get_params(self):
+        return {"n_lists": self.n_lists, "n_probe": self.n_probe, "n_iter": self.n_iter,
+                "seed": self.seed}
+
+    def build_index(self, embeddings):
+        self.index_of = embeddings
+        embeddings = embeddings.T if embeddings.shape[0] == self.k else embeddings
+        vectors = normalize_rows(embeddings)
+        n_lists = self.n_lists if self.n_lists else max(1, int(np.sqrt(len(vectors))))
+        n_lists = min(n_lists, len(vectors))
+
+        random_state = np.random.RandomState(self.seed)
+        centroids = vectors[random_state.choice(len(vectors), n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assignment = np.argmax(vectors @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, vectors)
+            # clusters that lost all of their members are re-seeded with random vectors
+            empty = np.bincount(assignment, minlength=n_lists) == 0
+            sums[empty] = vectors[random_state.choice(len(vectors), empty.sum())]
+            centroids = normalize_rows(sums)
+        assignment = np.argmax(vectors @ centroids.T, axis=1)
+
+        order = np.argsort(assignment, kind="stable")
+        list_offsets = np.zeros(n_lists + 1, dtype=int)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=list_offsets[1:])
+        self.index = {"vectors": vectors, "centroids": centroids, "members": order,
+                      "list_offsets": list_offsets}
+
+    def nearest_neighbors(self, embeddings, n_neighbors, subject_ids=None, subject_vectors=None,
+                          block_size=1024):
+        if self.index_of is not embeddings:
+            self.build_index(embeddings)
+        vectors = self.index["vectors"]
+        if subject_vectors is None:
+            subject_ids = np.arange(len(vectors)) if subject_ids is None else \
+                np.asarray(subject_ids)
+            queries = vectors[subject_ids]
+        else:
+            queries = subject_vectors.T if subject_vectors.shape[0] == self.k else \
+                subject_vectors
+            queries = normalize_rows(queries)
+
+        n_neighbors = min(n_neighbors, len(vectors) - (subject_ids is not None))
+        n_probe = min(self.n_probe, len(self.index["centroids"]))
+        members, list_offsets = self.index["members"], self.index["list_offsets"]
+        neighbors = np.full((len(queries), n_neighbors), -1)
+        similarities = np.full((len(queries), n_neighbors), -np.inf,
+                               dtype=np.result_type(vectors.dtype, np.float32))
+
+        # probe lists one at a time, merging the candidates of each list into the running top
+        # n_neighbors of the queries that probe it
+        probed, _ = top_k(queries @ self.index["centroids"].T, n_probe)
+        for cluster in np.unique(probed):
+            query_rows = np.nonzero((probed == cluster).any(axis=1))[0]
+            candidates = members[list_offsets[cluster]:list_offsets[cluster + 1]]
+            scores = queries[query_rows] @ vectors[candidates].T
+            if subject_ids is not None:
+                scores[candidates[None, :] == subject_ids[query_rows, None]] = -np.inf
+            merged_ids = np.hstack((neighbors[query_rows],
+                                    np.broadcast_to(candidates, scores.shape)))
+            merged_scores = np.hstack((similarities[query_rows], scores))
+            best, similarities[query_rows] = top_k(merged_scores, n_neighbors)
+            neighbors[query_rows] = np.take_along_axis(merged_ids, best, axis=1)
+
+        missing = np.nonzero((neighbors == -1).any(axis=1))[0]
+        if len(missing) > 0:
+            exact_neighbors = super().nearest_neighbors(
+                vectors, n_neighbors,
+                subject_ids=None if subject_ids is None else subject_ids[missing],
+                subject_vectors=None if subject_ids is not None else queries[missing],
+                block_size=block_size)
+            neighbors[missing], similarities[missing] = exact_neighbors
+        return neighbors, similarities
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+available_metrics = [CosineSimilarity, IVFCosineSimilarity]
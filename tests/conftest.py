@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the packages are imported from the repository root, as when running its modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from controllers.data_handler import DataHandler, usage_dtypes
+
+
+class SyntheticDataHandler(DataHandler):
+    # a DataHandler of a random dataset of n_users users previewing n_items templates, each of
+    # one to three of eight categories
+
+    def __init__(self, precision="double", n_users=1000, n_items=150, seed=0):
+        random_state = np.random.RandomState(seed)
+        rows = []
+        popularity = random_state.rand(n_items)
+        for user in range(n_users):
+            items = random_state.choice(n_items, random_state.randint(4, 25), replace=False)
+            selected = random_state.rand(len(items)) < 0.2 + 0.5 * popularity[items]
+            rows += zip([user] * len(items), items, selected.astype(int))
+        self.usage_data = pd.DataFrame(rows, columns=["user_index", "template_index",
+                                                      "is_selected"])
+        self.names = ["template %g" % item for item in range(n_items)]
+        categories = ["category %g" % c for c in range(8)]
+        self.metadata = {"": [{"configuration": name,
+                               "templateCategories": list(random_state.choice(
+                                   categories, random_state.randint(1, 4), replace=False)),
+                               "templateThumbnail": name + ".png"} for name in self.names]}
+        super().__init__({"project_name": "synthetic", "data_name": "synthetic",
+                          "precision": precision})
+
+    def LoadData(self, dataspecs):
+        users_map = pd.DataFrame({"user_index": np.arange(self.usage_data.user_index.max() + 1)})
+        users_map["id_for_vendor"] = "user " + users_map.user_index.astype(str)
+        items_map = pd.DataFrame({"template_index": np.arange(len(self.names)),
+                                  "template_name": self.names})
+        return self.usage_data.astype(usage_dtypes(dataspecs["precision"])), users_map, \
+            items_map
+
+    def LoadMetadata(self, dataspecs):
+        return self.metadata, "thumbnails/"
@@ -0,0 +1,20 @@
+import numpy as np
+
+from algorithms.RecSysAlgo import ItemsSVDAlgo
+from controllers.artifact_store import ArtifactStore
+from controllers.Model import artifact_key
+from similarity_functions.SimFunc import CosineSimilarity, IVFCosineSimilarity
+
+
+def test_similarity_function_parameters_in_key(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    algo = ItemsSVDAlgo()
+
+    def knn_key(sim_func):
+        return artifact_key(store, algo, 10, "fingerprint", sim_func, np.float32, knn_size=100)
+
+    assert knn_key(IVFCosineSimilarity(10, n_lists=5, n_probe=1)) != \
+        knn_key(IVFCosineSimilarity(10, n_lists=5, n_probe=5))
+    assert knn_key(IVFCosineSimilarity(10, seed=0)) != knn_key(IVFCosineSimilarity(10, seed=1))
+    assert knn_key(IVFCosineSimilarity(10)) == knn_key(IVFCosineSimilarity(10))
+    assert knn_key(CosineSimilarity(10)) != knn_key(IVFCosineSimilarity(10))
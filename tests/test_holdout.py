@@ -0,0 +1,23 @@
+import numpy as np
+
+from synthetic import SyntheticDataHandler
+
+
+def test_loo_dataset_follows_seed():
+    dh = SyntheticDataHandler(n_users=300, n_items=60)
+    data, left_out = dh.prepare_LOO_dataset(seed=0)
+    # the same seed, or no seed, reuses the split
+    assert dh.prepare_LOO_dataset(seed=0)[0] is data
+    assert dh.prepare_LOO_dataset()[0] is data
+    # a different seed draws it again
+    _, redrawn = dh.prepare_LOO_dataset(seed=1)
+    assert not np.array_equal(redrawn, left_out)
+    assert np.array_equal(dh.prepare_LOO_dataset(seed=0)[1], left_out)
+
+
+def test_fold_dataset_follows_parameters():
+    dh = SyntheticDataHandler(n_users=300, n_items=60)
+    data, left_out = dh.prepare_fold_dataset(0, 5, seed=0, dataset="fold")
+    assert dh.prepare_fold_dataset(0, 5, seed=0, dataset="fold")[0] is data
+    assert not np.array_equal(dh.prepare_fold_dataset(1, 5, seed=0, dataset="fold")[1],
+                              left_out)
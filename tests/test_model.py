@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from algorithms.RecSysAlgo import ItemsSVDAlgo, ItemsUsersSVDAlgo
+from controllers.artifact_store import ArtifactStore
+from controllers.Model import LowDimEmbeddingModel
+from similarity_functions.SimFunc import CosineSimilarity
+from synthetic import SyntheticDataHandler
+
+
+@pytest.mark.parametrize("algo_class", [ItemsSVDAlgo, ItemsUsersSVDAlgo])
+def test_stored_embeddings_skip_the_fit(algo_class, tmp_path):
+    data = SyntheticDataHandler(n_users=300, n_items=60).getData("all")
+    fits = []
+
+    class CountingAlgo(algo_class):
+        def fit(self, RecSysData, k):
+            fits.append(k)
+            super().fit(RecSysData, k)
+
+    item_embeddings = []
+    for _ in range(2):
+        model = LowDimEmbeddingModel(CountingAlgo(solver="arpack"), 4, CosineSimilarity,
+                                     store=ArtifactStore(str(tmp_path)))
+        item_embeddings.append(np.asarray(model.GetItemEmbeddings(data)))
+    assert fits == [4]
+    assert np.array_equal(item_embeddings[0], item_embeddings[1])
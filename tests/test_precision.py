@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from algorithms.RecSysAlgo import ItemsSVDAlgo, ItemsUsersSVDAlgo
+from recommendation.Recommender import ItemSimilarityRecommender, UserBasedRecommender
+from similarity_functions.SimFunc import CosineSimilarity
+from synthetic import SyntheticDataHandler
+
+# largest differences allowed between the metrics in single and in double precision
+HIT_RATE_TOLERANCE = 0.01
+MATCH_INDEX_TOLERANCE = 1e-3
+SCORES_CHART = {"0": -0.5, "1": 1}
+
+
+def evaluate(recommender_class, algo, precision):
+    dh = SyntheticDataHandler(precision)
+    dh.prepare_LOO_dataset(seed=0)
+    recommender = recommender_class(dh, algo, 10, CosineSimilarity, SCORES_CHART)
+    return recommender.calc_hit_rate(10), recommender.calc_match_index(10)
+
+
+@pytest.mark.parametrize("recommender_class, algo_class", [
+    (ItemSimilarityRecommender, ItemsSVDAlgo), (UserBasedRecommender, ItemsUsersSVDAlgo)])
+def test_single_precision_metrics(recommender_class, algo_class):
+    double_hit_rate, double_match_index = evaluate(recommender_class,
+                                                   algo_class(solver="arpack"), "double")
+    single_hit_rate, single_match_index = evaluate(recommender_class,
+                                                   algo_class(solver="arpack"), "single")
+    assert abs(single_hit_rate - double_hit_rate) <= HIT_RATE_TOLERANCE
+    assert abs(single_match_index - double_match_index) <= MATCH_INDEX_TOLERANCE
+
+
+def test_single_precision_dtypes():
+    dh = SyntheticDataHandler("single")
+    data, _ = dh.prepare_LOO_dataset(seed=0)
+    assert data.user_index.dtype == np.int32 and data.is_selected.dtype == np.int8
+    recommender = ItemSimilarityRecommender(dh, ItemsSVDAlgo(solver="arpack"), 10,
+                                            CosineSimilarity, SCORES_CHART)
+    assert recommender.model.GetSimilarities(dh.getData("LOO")).dtype == np.float32
@@ -0,0 +1,29 @@
+import numpy as np
+
+from algorithms import RecSysAlgo
+from algorithms.RecSysAlgo import ItemsSVDAlgo, SVD_CACHE_SIZE, set_svd_cache_size
+from controllers.Evaluator import init_worker
+from synthetic import SyntheticDataHandler
+
+
+def test_svd_cache_size():
+    data = SyntheticDataHandler(n_users=300, n_items=60).getData("all")
+    try:
+        set_svd_cache_size(0)
+        algo = ItemsSVDAlgo(solver="arpack")
+        algo.fit(data, 8)
+        assert len(RecSysAlgo.svd_cache) == 0
+
+        set_svd_cache_size(1)
+        algo.fit(data, 8)
+        cached = algo.item_embeddings
+        algo.fit(data, 4)
+        assert len(RecSysAlgo.svd_cache) == 1
+        assert np.array_equal(algo.item_embeddings, cached[:4])
+        ItemsSVDAlgo(replace_zero_by=0, solver="arpack").fit(data, 4)
+        assert len(RecSysAlgo.svd_cache) == 1
+
+        init_worker(None)
+        assert len(RecSysAlgo.svd_cache) == 0
+    finally:
+        set_svd_cache_size(SVD_CACHE_SIZE)
@@ -0,0 +1,20 @@
+from algorithms.RecSysAlgo import ImplicitALSAlgo, ItemsSVDAlgo, RandomEmbeddingAlgo
+from controllers.Evaluator import Evaluator
+from synthetic import SyntheticDataHandler
+
+
+def test_sweep_over_svd_and_other_algorithms():
+    dh = SyntheticDataHandler(n_users=300, n_items=60)
+    grid = {"algo": [ItemsSVDAlgo, ImplicitALSAlgo, RandomEmbeddingAlgo],
+            "algo_params": {ItemsSVDAlgo: [{"solver": "arpack"}],
+                            ImplicitALSAlgo: [{"n_iter": 2}, {"n_iter": 4}]},
+            "replace_zero_by": [-1, 0], "k": [4, 8]}
+    results = Evaluator().sweep(dh, grid, ["hit_rate", "match_index"])
+
+    # replace_zero_by only multiplies the grid of the SVD algorithm
+    assert len(results) == 2 * 2 + 2 * 2 + 2
+    assert set(results.replace_zero_by[results.algo == "ItemsSVDAlgo"]) == {-1, 0}
+    assert results.replace_zero_by[results.algo != "ItemsSVDAlgo"].isna().all()
+    assert set(results.algo_params[results.algo == "ImplicitALSAlgo"]) == \
+        {"{'n_iter': 2}", "{'n_iter': 4}"}
+    assert results.hit_rate.between(0, 1).all() and results.match_index.notna().all()
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from data.processing.to_RecSys_format import BINARY_COLUMNS, to_recsys_format
+
+
+def test_binary_dataset_round_trip(tmp_path, monkeypatch):
+    # build a dataset from a small raw export, in several chunks and partitions, and load its
+    # binary copy back
+    random_state = np.random.RandomState(0)
+    num_events = 2000
+    os.makedirs(tmp_path / "query data")
+    pd.DataFrame({
+        "id_for_vendor": ["user %g" % u for u in random_state.randint(0, 100, num_events)],
+        "template_name": ["template %g" % t for t in random_state.randint(0, 30, num_events)],
+        "is_selected": random_state.rand(num_events) < 0.3}).to_csv(
+        tmp_path / "query data" / "demo for test.csv", index=False)
+    os.makedirs(tmp_path / "processing")
+    monkeypatch.chdir(tmp_path / "processing")
+
+    to_recsys_format("test", 5, chunk_size=300, n_partitions=4)
+
+    data_path = tmp_path / "RecSys data" / "test" / "min_previews 5"
+    usage_data = pd.read_csv(str(data_path) + ".csv")
+    for column, dtype in BINARY_COLUMNS.items():
+        array = np.load(data_path / (column + ".npy"))
+        assert array.dtype == dtype
+        assert np.array_equal(array, usage_data[column].values)
+
+    indptr = np.load(data_path / "indptr.npy")
+    assert np.array_equal(np.diff(indptr), np.bincount(usage_data.user_index))
+    users_map = pd.read_csv("test/min_previews 5 users_map")
+    templates_map = pd.read_csv("test/min_previews 5 templates_map")
+    id_for_vendor = np.load(data_path / "id_for_vendor.npy")
+    template_name = np.load(data_path / "template_name.npy")
+    assert id_for_vendor.dtype.kind == "U" and template_name.dtype.kind == "U"
+    assert np.array_equal(id_for_vendor, users_map.id_for_vendor.values)
+    assert np.array_equal(template_name, templates_map.template_name.values)